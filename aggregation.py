@@ -0,0 +1,99 @@
+#####AGGREGATE GEOCODED APPLICANTS INTO MAP CELLS AND REGIONS#####
+# For cohorts too large for one marker per applicant: points are binned into geohash cells
+# (vectorized over the whole frame) and addresses are rolled up by country/state, both broken
+# down by the medical school type the marker map colors by.
+import numpy as np
+import pandas as pd
+
+from applicant_map import MARKER_STYLES, marker_styles
+
+
+GEOHASH_ALPHABET = np.array(list('0123456789bcdefghjkmnpqrstuvwxyz'))
+GEOHASH_PRECISION = 4
+GEOHASH_MAX_PRECISION = 12  # 60 bits, the most an int64 code can hold
+# approximate cell size at each precision, for the app's picker
+GEOHASH_CELL_SIZES = {2: '~1250 x 625 km', 3: '~156 x 156 km', 4: '~39 x 20 km', 5: '~5 x 5 km'}
+MEDSCHOOL_LABELS = [label for color, label in MARKER_STYLES]
+
+# "..., Springfield, IL 62701" optionally followed by ", USA" / ", United States"
+US_STATE_ZIP = r',\s*([A-Z]{2})\s+\d{5}(?:-\d{4})?(?:\s*,\s*(?:USA|US|UNITED STATES(?: OF AMERICA)?))?\s*$'
+
+
+def geohash_bits(precision):
+    if not 1 <= precision <= GEOHASH_MAX_PRECISION:
+        raise ValueError(f"geohash precision must be between 1 and {GEOHASH_MAX_PRECISION}, got {precision}")
+    bits = 5 * precision
+    #geohash interleaves bits starting with longitude, so longitude gets the odd one out
+    return bits, bits // 2, (bits + 1) // 2
+
+
+# GEOHASH OF EVERY POINT AS AN INTEGER (5 bits per character), one bit position at a time over all points
+def geohash_codes(lat, lng, precision=GEOHASH_PRECISION):
+    bits, lat_bits, lng_bits = geohash_bits(precision)
+    lat_i = np.clip(((np.asarray(lat, dtype='float64') + 90) / 180 * 2 ** lat_bits).astype(np.int64), 0, 2 ** lat_bits - 1)
+    lng_i = np.clip(((np.asarray(lng, dtype='float64') + 180) / 360 * 2 ** lng_bits).astype(np.int64), 0, 2 ** lng_bits - 1)
+    codes = np.zeros(len(lat_i), dtype=np.int64)
+    for bit in range(bits):
+        if bit % 2 == 0:
+            codes = (codes << 1) | ((lng_i >> (lng_bits - 1 - bit // 2)) & 1)
+        else:
+            codes = (codes << 1) | ((lat_i >> (lat_bits - 1 - bit // 2)) & 1)
+    return codes
+
+
+def geohash_strings(codes, precision=GEOHASH_PRECISION):
+    cells = GEOHASH_ALPHABET[(codes >> (5 * (precision - 1))) & 31]
+    for i in range(1, precision):
+        cells = np.char.add(cells, GEOHASH_ALPHABET[(codes >> (5 * (precision - 1 - i))) & 31])
+    return cells
+
+
+# CENTER (lat, lng) OF EACH GEOHASH CELL
+def geohash_centers(codes, precision=GEOHASH_PRECISION):
+    bits, lat_bits, lng_bits = geohash_bits(precision)
+    lat_i = np.zeros(len(codes), dtype=np.int64)
+    lng_i = np.zeros(len(codes), dtype=np.int64)
+    for bit in range(bits):
+        value = (codes >> (bits - 1 - bit)) & 1
+        if bit % 2 == 0:
+            lng_i = (lng_i << 1) | value
+        else:
+            lat_i = (lat_i << 1) | value
+    return (lat_i + 0.5) * 180 / 2 ** lat_bits - 90, (lng_i + 0.5) * 360 / 2 ** lng_bits - 180
+
+
+# ONE ROW PER OCCUPIED CELL: cell, lat, lng (cell center), a count per medical school type and total
+# geo_df rows without coordinates must already be dropped
+def aggregate_cells(geo_df, precision=GEOHASH_PRECISION):
+    codes = geohash_codes(geo_df['lat'], geo_df['lng'], precision)
+    cell_codes, cell_of_row = np.unique(codes, return_inverse=True)
+    counts = np.zeros((len(cell_codes), len(MARKER_STYLES)), dtype=np.int64)
+    np.add.at(counts, (cell_of_row, marker_styles(geo_df['Medical School Type']).to_numpy()), 1)
+    lat, lng = geohash_centers(cell_codes, precision)
+    cells = pd.DataFrame(counts, columns=MEDSCHOOL_LABELS)
+    cells.insert(0, 'cell', geohash_strings(cell_codes, precision))
+    cells.insert(1, 'lat', lat)
+    cells.insert(2, 'lng', lng)
+    cells['total'] = counts.sum(axis=1)
+    return cells.sort_values('total', ascending=False, ignore_index=True)
+
+
+# COUNTRY AND US STATE OF EACH PERMANENT ADDRESS, parsed from its trailing "ST 12345" or last comma part
+def address_regions(addresses):
+    addresses = addresses.astype(str).str.strip().str.upper()
+    state = addresses.str.extract(US_STATE_ZIP, expand=False)
+    last_part = addresses.str.rsplit(',', n=1).str[-1].str.replace(r'[\d-]+', '', regex=True).str.strip()
+    last_part = last_part.where(addresses.str.contains(',', regex=False), '')
+    country = last_part.where(state.isna(), 'USA').replace('', 'UNKNOWN')
+    return pd.DataFrame({'country': country, 'state': state.fillna('')}, index=addresses.index)
+
+
+# ONE ROW PER country/state WITH A COUNT PER MEDICAL SCHOOL TYPE AND total
+def aggregate_regions(geo_df):
+    regions = address_regions(geo_df['Permanent Address'])
+    styles = marker_styles(geo_df['Medical School Type'])
+    counts = pd.crosstab([regions['country'], regions['state']], styles)
+    counts = counts.reindex(columns=range(len(MARKER_STYLES)), fill_value=0)
+    counts.columns = MEDSCHOOL_LABELS
+    counts['total'] = counts.sum(axis=1)
+    return counts.sort_values('total', ascending=False).reset_index()
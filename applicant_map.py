@@ -0,0 +1,174 @@
+#####BUILD THE FOLIUM APPLICANT MAP#####
+import base64
+import json
+
+import folium
+import numpy as np
+import pandas as pd
+from folium.plugins import MarkerCluster, FastMarkerCluster, HeatMap
+
+
+# POPUP FIELDS: (label shown in the popup, CSV column)
+POPUP_FIELDS = [
+    ('AAMC ID', 'AAMC ID'),
+    ('Med School', 'Medical School of Graduation'),
+    ('Med School Type', 'Medical School Type'),
+    ('Country', 'Medical School Country'),
+    ('Graduation Date', 'Medical School Degree Date of Graduation'),
+    ('USMLE Step 1', 'USMLE Step 1 Status'),
+    ('USMLE Step 1 Score', 'USMLE Step 1 Score'),
+    ('USMLE Step 2 CK', 'USMLE Step 2 CK Score'),
+    ('USMLE Step 2 CS', 'USMLE Step 2 CS Score'),
+    ('USMLE Step 3', 'USMLE Step 3 Score'),
+    ('COMLEX Level 1', 'COMLEX-USA Level 1 Status'),
+    ('COMLEX Level 1 Score', 'COMLEX-USA Level 1 Score'),
+    ('COMLEX Level 2 CE', 'COMLEX-USA Level 2 CE Score'),
+    ('COMLEX Level 3', 'COMLEX-USA Level 3 Score'),
+    ('Division Pref', 'Division_Preference'),
+]
+left_col_color = "#3e95b5"
+right_col_color = "#f2f9ff"
+POPUP_ROW_TEMPLATE = (
+    '<tr>'
+    '<td style="background-color: {left}; padding: 5px"><span style="color: #ffffff;"> {label} </span></td>'
+    '<td style="width: 150px;background-color: {right}; padding: 5px">'
+)
+POPUP_ROW_PREFIXES = [
+    (POPUP_ROW_TEMPLATE.format(left=left_col_color, right=right_col_color, label=label), column)
+    for label, column in POPUP_FIELDS
+]
+
+# MARKER COLOR AND TOOLTIP BY MEDICAL SCHOOL TYPE, ANYTHING ELSE IS AN IMG
+MARKER_STYLES = [('red', 'MD-US-Grad'), ('darkblue', 'DO-US-Grad'), ('gray', 'MD-IMG-Grad')]
+MEDSCHOOL_MARKERS = {
+    'US M.D. Private School': 0,
+    'US M.D. Public School': 0,
+    'US D.O. School': 1,
+}
+IMG_MARKER = 2
+
+
+# PHOTO FOR EACH APPLICANT: an inline data URI when thumbnails ({aamc id: jpeg bytes}) are given, else the JPEG next to the HTML file
+def image_sources(aamc_ids, thumbnails=None):
+    aamc_ids = aamc_ids.astype(str)
+    file_names = aamc_ids + '.jpg'
+    if not thumbnails:
+        return file_names
+    data_uris = {aamc_id: 'data:image/jpeg;base64,' + base64.b64encode(data).decode('ascii') for aamc_id, data in thumbnails.items()}
+    return aamc_ids.map(data_uris).fillna(file_names)
+
+
+# Create POPUP HTML FOR EVERY APPLICANT IN ONE COLUMN-WISE PASS
+# image_srcs is the output of image_sources(), or None to leave photos out
+def popup_html(geo_df, image_srcs=None):
+    if image_srcs is not None:
+        image_html = '<center><img src="' + image_srcs + '" alt="logo" width=100 height=100 ></center>'
+    else:
+        image_html = '<center></center>'
+    html = (
+        '<!DOCTYPE html><html>' + image_html
+        + '<center><h4 style="margin-bottom:5"; width="200px">' + geo_df['Applicant Name'].astype(str) + '</h4></center>'
+        + '<center> <table style="height: 126px; width: 305px;"><tbody>'
+    )
+    for row_prefix, column in POPUP_ROW_PREFIXES:
+        values = geo_df[column].astype(str) if column in geo_df else ''
+        html = html + row_prefix + values + '</td></tr>'
+    return html + '</tbody></table></center></html>'
+
+
+def marker_styles(medschool_types):
+    return medschool_types.astype(object).map(MEDSCHOOL_MARKERS).fillna(IMG_MARKER).astype(int)
+
+
+# LIGHTWEIGHT MARKER LAYER: coordinates and popup fields are sent once as a compact array
+# and each popup is assembled in the browser only when its marker is clicked
+FAST_MARKER_CALLBACK = """
+    function (row) {
+        var styles = %(styles)s;
+        var rowPrefixes = %(row_prefixes)s;
+        var style = styles[row[2]];
+        var icon = L.AwesomeMarkers.icon({icon: 'user', prefix: 'fa', markerColor: style[0]});
+        var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: icon});
+        marker.bindTooltip(style[1]);
+        marker.bindPopup(function () {
+            var html = %(show_image)s ? '<center><img src="' + row[3] + '" alt="logo" width=100 height=100 ></center>' : '<center></center>';
+            html += '<center><h4 style="margin-bottom:5"; width="200px">' + row[4] + '</h4></center>';
+            html += '<center> <table style="height: 126px; width: 305px;"><tbody>';
+            for (var i = 0; i < rowPrefixes.length; i++) {
+                html += rowPrefixes[i] + row[5 + i] + '</td></tr>';
+            }
+            return html + '</tbody></table></center>';
+        }, {maxWidth: 400});
+        return marker;
+    }
+"""
+
+
+def fast_marker_layer(geo_df, image_srcs=None):
+    data = pd.DataFrame({
+        'lat': geo_df['lat'],
+        'lng': geo_df['lng'],
+        'style': marker_styles(geo_df['Medical School Type']),
+        'image_src': image_srcs if image_srcs is not None else '',
+        'name': geo_df['Applicant Name'].astype(str),
+    })
+    for i, (row_prefix, column) in enumerate(POPUP_ROW_PREFIXES):
+        data[i] = geo_df[column].astype(str) if column in geo_df else ''
+    callback = FAST_MARKER_CALLBACK % {
+        'styles': json.dumps(MARKER_STYLES),
+        'row_prefixes': json.dumps([row_prefix for row_prefix, column in POPUP_ROW_PREFIXES]),
+        'show_image': 'true' if image_srcs is not None else 'false',
+    }
+    return FastMarkerCluster(data.values.tolist(), callback=callback)
+
+
+# BUILD THE MAP FROM GEOCODED APPLICANTS (rows without coordinates must already be dropped)
+def build_map(geo_df, lightweight=False, image_srcs=None):
+    m = folium.Map(location=geo_df[["lat", "lng"]].mean().to_list(), zoom_start=2)
+    if lightweight:
+        fast_marker_layer(geo_df, image_srcs).add_to(m)
+        return m
+    # if the points are too close to each other, cluster them, create a cluster overlay with MarkerCluster, add to m
+    marker_cluster = MarkerCluster().add_to(m)
+    # popups, colors and tooltips come straight from geo_df so they stay aligned with each marker
+    popups = popup_html(geo_df, image_srcs)
+    styles = marker_styles(geo_df['Medical School Type'])
+    # add the markers the the cluster layers so that they are automatically clustered
+    for lat, lng, html, style in zip(geo_df['lat'], geo_df['lng'], popups, styles):
+        color, tooltip = MARKER_STYLES[style]
+        folium.Marker(location=(lat, lng), popup=html, tooltip=tooltip, icon=folium.Icon(color=color, icon='user', prefix='fa')).add_to(marker_cluster)
+    return m
+
+
+# POPUP FOR EACH AGGREGATE CELL: applicants per medical school type, built column-wise like popup_html
+def cell_popup_html(cells):
+    html = '<center><h4 style="margin-bottom:5"; width="200px">' + cells['total'].astype(str) + ' applicant(s)</h4></center><center><table><tbody>'
+    for color, label in MARKER_STYLES:
+        row_prefix = POPUP_ROW_TEMPLATE.format(left=left_col_color, right=right_col_color, label=label)
+        html = html + row_prefix + cells[label].astype(str) + '</td></tr>'
+    return html + '</tbody></table></center>'
+
+
+# AGGREGATE MAP FOR LARGE COHORTS: cells is aggregation.aggregate_cells() output
+# a heatmap weighted by applicants plus one circle per occupied cell, colored by its most common
+# medical school type, so the HTML grows with the number of cells rather than applicants
+def build_aggregate_map(cells):
+    weights = cells['total'].to_numpy()
+    relative = weights / weights.max()
+    m = folium.Map(
+        location=[np.average(cells['lat'], weights=weights), np.average(cells['lng'], weights=weights)],
+        zoom_start=2
+    )
+    #leaflet.heat saturates at weight 1, so weights are relative to the busiest cell
+    HeatMap(np.column_stack([cells['lat'], cells['lng'], relative]).tolist(), name='Heatmap', radius=20, blur=15).add_to(m)
+    counts_layer = folium.FeatureGroup(name='Applicants per area')
+    colors = [MARKER_STYLES[style][0] for style in cells[[label for color, label in MARKER_STYLES]].to_numpy().argmax(axis=1)]
+    radii = 4 + 15 * np.sqrt(relative)
+    for lat, lng, total, html, color, radius in zip(cells['lat'], cells['lng'], weights, cell_popup_html(cells), colors, radii):
+        folium.CircleMarker(
+            location=(lat, lng), radius=float(radius), color=color, fill=True, fill_opacity=0.6,
+            popup=folium.Popup(html, max_width=400), tooltip=f"{total} applicant(s)"
+        ).add_to(counts_layer)
+    counts_layer.add_to(m)
+    folium.LayerControl().add_to(m)
+    return m
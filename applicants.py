@@ -0,0 +1,68 @@
+#####READ AND CLEAN ERAS APPLICANT EXPORTS#####
+import pandas as pd
+
+
+expected_headers = ['Permanent Address', 'Applicant Name', 'AAMC ID', 'Medical School of Graduation', 'Medical School Type']
+optional_headers = ['Medical School Country', 'Medical School Degree Date of Graduation', 'USMLE Step 1 Status','USMLE Step 1 Score', 'USMLE Step 2 CK Score', 'USMLE Step 2 CS Score', 'USMLE Step 3 Score','COMLEX-USA Level 1 Status', 'COMLEX-USA Level 1 Score', 'COMLEX-USA Level 2 CE Score', 'COMLEX-USA Level 2 PE Score', 'COMLEX-USA Level 3 Score', 'Division_Preference']
+
+# CSV INGESTION: only the columns the app uses are parsed, everything as text except a few low-cardinality ones
+CATEGORICAL_HEADERS = ['Medical School Type', 'Medical School Country', 'USMLE Step 1 Status', 'COMLEX-USA Level 1 Status', 'Division_Preference']
+CSV_DTYPES = {col: 'category' if col in CATEGORICAL_HEADERS else str for col in expected_headers + optional_headers}
+
+
+def read_applicants(csv_file, chunksize=None):
+    #with chunksize this returns an iterator of frames so large exports can be processed piece by piece
+    return pd.read_csv(
+        csv_file,
+        usecols=lambda col: col in CSV_DTYPES,
+        dtype=CSV_DTYPES,
+        chunksize=chunksize
+    )
+
+
+def missing_required_headers(df):
+    return [x for x in expected_headers if x not in set(df.columns.tolist())]
+
+
+# ADD ANY MISSING OPTIONAL HEADERS AS EMPTY COLUMNS AND CLEAN UP THE ADDRESS
+def prepare_applicants(df):
+    missing_headers = [i for i in optional_headers if i not in set(df.columns.tolist())]
+    if missing_headers:
+        df = df.reindex(columns=df.columns.tolist() + list(missing_headers))
+    df['Permanent Address'] = df['Permanent Address'].str.replace('#', '')
+    return df
+
+
+# COLLAPSE ADDRESSES THAT DIFFER ONLY IN CASE, WHITESPACE OR PUNCTUATION TO ONE KEY
+def normalize_addresses(addresses):
+    return (
+        addresses.astype(str)
+        .str.lower()
+        .str.replace(r"[^\w\s]", " ", regex=True)
+        .str.replace(r"\s+", " ", regex=True)
+        .str.strip()
+    )
+
+
+# APPLICANT + ADDRESS KEY FOR MATCHING ROWS AGAINST A PREVIOUS RUN
+def applicant_keys(frame):
+    #AAMC ID turns into a float when the column has blanks
+    aamc_ids = frame['AAMC ID'].astype(str).str.replace(r"\.0$", "", regex=True)
+    return aamc_ids + '|' + normalize_addresses(frame['Permanent Address'])
+
+
+# previous_file is a path or an uploaded file, either way it has a name ending in .csv or .parquet
+def read_previous_run(previous_file):
+    file_name = str(getattr(previous_file, 'name', previous_file))
+    if file_name.lower().endswith('.parquet'):
+        previous = pd.read_parquet(previous_file)
+    else:
+        previous = pd.read_csv(previous_file)
+    return previous.dropna(subset=['lat', 'lng'])
+
+
+# COORDINATES FOR ROWS WHOSE AAMC ID AND ADDRESS ARE UNCHANGED SINCE THE PREVIOUS RUN, NaN FOR THE REST
+def reuse_previous_coordinates(df, previous):
+    previous_coords = previous[['lat', 'lng']].set_axis(applicant_keys(previous))
+    previous_coords = previous_coords[~previous_coords.index.duplicated(keep='last')]
+    return previous_coords.reindex(applicant_keys(df)).set_axis(df.index)
@@ -0,0 +1,279 @@
+#####OFFLINE PIPELINE BENCHMARK#####
+# Runs ingest -> geocode -> popups -> aggregate -> map save -> photo ZIP headless on synthetic ERAS data,
+# geocoding against mock_geocoder.py so no network or API key is needed.
+#
+#   python benchmark.py --sizes 100 1000 5000 20000 --latency 0.02 --error-rate 0.01 --json bench.json
+import argparse
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from applicants import expected_headers, optional_headers, read_applicants, prepare_applicants
+from geocoding import geocode_addresses, new_geocode_stats
+from applicant_map import popup_html, build_map, build_aggregate_map
+from aggregation import GEOHASH_PRECISION, aggregate_cells, aggregate_regions
+from mock_geocoder import start_mock_geocoder, UNKNOWN_ADDRESS_MARKER
+from pdf_photos import zip_pdf_images, photo_name
+
+
+MEDSCHOOL_TYPES = ['US M.D. Private School', 'US M.D. Public School', 'US D.O. School', 'International School']
+
+
+# SYNTHETIC ERAS EXPORT WITH THE COLUMNS THE APP USES PLUS UNUSED ONES
+# shared_address_rate of rows reuse another row's address with different case/punctuation
+def synthetic_applicants_csv(n, seed=0, shared_address_rate=0.2, unused_columns=60, unknown_address_rate=0.01):
+    rng = np.random.default_rng(seed)
+    addresses = pd.Series([f"{rng.integers(1, 9999)} Main St #{i}, Springfield, ST {10000 + i % 89999}" for i in range(n)])
+    shared = rng.random(n) < shared_address_rate
+    addresses[shared] = addresses.sample(shared.sum(), replace=True, random_state=seed).str.upper().str.replace(',', '').values
+    unknown = rng.random(n) < unknown_address_rate
+    addresses[unknown] = f"{UNKNOWN_ADDRESS_MARKER} " + addresses[unknown]
+
+    columns = {header: [f"{header} {i % 300}" for i in range(n)] for header in expected_headers + optional_headers}
+    columns['Permanent Address'] = addresses
+    columns['AAMC ID'] = np.arange(10000000, 10000000 + n)
+    columns['Applicant Name'] = [f"Applicant {i}" for i in range(n)]
+    columns['Medical School Type'] = rng.choice(MEDSCHOOL_TYPES, n)
+    columns['USMLE Step 1 Score'] = rng.integers(200, 270, n)
+    for j in range(unused_columns):
+        columns[f"Unused Field {j}"] = [f"lorem ipsum {j} {i}" for i in range(n)]
+    return pd.DataFrame(columns).to_csv(index=False).encode('utf-8')
+
+
+# SINGLE-PAGE PDF WITH ONE /FlateDecode /DeviceRGB IMAGE, as scanners and PDF printers write them
+def flate_photo_pdf(img):
+    samples = zlib.compress(img.convert('RGB').tobytes())
+    width, height = img.size
+    content = f"q {width} 0 0 {height} 0 0 cm /Im0 Do Q".encode()
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width} {height}] /Resources << /XObject << /Im0 4 0 R >> >> /Contents 5 0 R >>".encode(),
+        f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} /ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /FlateDecode /Length {len(samples)} >>\nstream\n".encode() + samples + b"\nendstream",
+        f"<< /Length {len(content)} >>\nstream\n".encode() + content + b"\nendstream",
+    ]
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    pdf += b"".join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(pdf)
+
+
+# ONE SINGLE-PAGE PDF PER APPLICANT WITH AN EMBEDDED PHOTO, NAMED LIKE THE ERAS BULK PRINT
+# every flate_every-th photo is a Flate image, which has to be decoded and re-encoded instead of copied
+def synthetic_photo_pdfs(aamc_ids, size=(600, 800), flate_every=4):
+    pdfs = []
+    for i, aamc_id in enumerate(aamc_ids):
+        img = Image.new('RGB', size, (aamc_id % 255, 120, 80))
+        if flate_every and i % flate_every == flate_every - 1:
+            pdf_bytes = flate_photo_pdf(img)
+        else:
+            pdf_io = BytesIO()
+            img.save(pdf_io, 'PDF')
+            pdf_bytes = pdf_io.getvalue()
+        pdfs.append((f"Photograph_{aamc_id}_1.pdf", pdf_bytes))
+    return pdfs
+
+
+# PEAK RESIDENT MEMORY OF THIS PROCESS WHILE THE BLOCK RUNS, SAMPLED FROM /proc
+# children_peak is the most its child processes (the photo workers) held at once, summed over all of them
+class PeakRSS:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self.children_peak = 0
+        self.stopped = threading.Event()
+
+    @staticmethod
+    def current():
+        try:
+            with open('/proc/self/statm') as statm:
+                return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            #no /proc (macOS): fall back to the lifetime peak
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    @staticmethod
+    def children():
+        try:
+            pids = set()
+            for task in os.listdir('/proc/self/task'):
+                with open(f'/proc/self/task/{task}/children') as children:
+                    pids.update(children.read().split())
+        except OSError:
+            #no /proc: the largest child reaped so far
+            return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        total = 0
+        for pid in pids:
+            try:
+                with open(f'/proc/{pid}/statm') as statm:
+                    total += int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            except OSError:
+                #exited between listing and reading
+                pass
+        return total
+
+    def sample(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, self.current())
+            self.children_peak = max(self.children_peak, self.children())
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self.current()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if len(values) else None
+
+
+# RUN EVERY STAGE FOR ONE SIZE AND RETURN {stage: {seconds, items, peak_rss_mb, ...}}
+def run_pipeline(csv_bytes, pdfs, geocode_url, args, workdir):
+    results = {}
+
+    def timed(stage, items, fn):
+        with PeakRSS() as rss:
+            started = time.perf_counter()
+            value = fn()
+            seconds = time.perf_counter() - started
+        results[stage] = {'seconds': seconds, 'items': items, 'peak_rss_mb': rss.peak / 1024 / 1024,
+                          'children_peak_rss_mb': rss.children_peak / 1024 / 1024}
+        return value
+
+    df = timed('ingest', None, lambda: prepare_applicants(read_applicants(BytesIO(csv_bytes))))
+    results['ingest']['items'] = len(df)
+    df = df.dropna(subset=['Permanent Address'])
+
+    stats = new_geocode_stats()
+    coords = timed('geocode', len(df), lambda: geocode_addresses(
+        df['Permanent Address'], api_key='benchmark', base_url=geocode_url, stats=stats,
+        max_workers=args.workers, qps=args.qps
+    ))
+    latencies = stats['latencies']
+    results['geocode'].update({
+        'unique_addresses': stats['unique'],
+        'http_requests': stats['requests'],
+        'request_p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+        'request_p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+    })
+    geo_df = df.join(coords).dropna(subset=['lat'])
+
+    timed('popups', len(geo_df), lambda: popup_html(geo_df))
+    map_path = os.path.join(workdir, 'geo_applicants.html')
+    cells = timed('aggregate', len(geo_df), lambda: (aggregate_regions(geo_df), aggregate_cells(geo_df, args.precision))[1])
+    results['aggregate']['cells'] = len(cells)
+    if args.aggregate:
+        timed('map_save', len(geo_df), lambda: build_aggregate_map(cells).save(map_path))
+    else:
+        timed('map_save', len(geo_df), lambda: build_map(geo_df, lightweight=args.lightweight).save(map_path))
+    results['map_save']['bytes'] = os.path.getsize(map_path)
+
+    def zip_photos():
+        zip_buffer = BytesIO()
+        pdf_jobs = [(name, photo_name(name), (lambda data=data: data)) for name, data in pdfs]
+        with zipfile.ZipFile(zip_buffer, "w") as zipf:
+            totals = zip_pdf_images(zipf, pdf_jobs)
+        return zip_buffer.getbuffer().nbytes, totals
+    zip_bytes, totals = timed('zip', len(pdfs), zip_photos)
+    results['zip'].update({'bytes': zip_bytes, 'copied': totals['copied'], 'reencoded': totals['reencoded']})
+    #every Flate photo must come out of the ZIP re-encoded, not dropped as unreadable
+    flate_photos = sum(b'/FlateDecode /Length' in data for name, data in pdfs)
+    if totals['reencoded'] != flate_photos or totals['images'] != len(pdfs):
+        raise RuntimeError(f"expected {flate_photos} re-encoded of {len(pdfs)} photos, got {totals}")
+    return results
+
+
+# COMBINE REPEATED RUNS: throughput from the median, p50/p99 of stage wall time across repeats
+def summarize(runs):
+    summary = {}
+    for stage in runs[0]:
+        seconds = [run[stage]['seconds'] for run in runs]
+        items = runs[0][stage]['items']
+        summary[stage] = {
+            'items': items,
+            'p50_seconds': percentile(seconds, 50),
+            'p99_seconds': percentile(seconds, 99),
+            'items_per_second': items / percentile(seconds, 50) if items and percentile(seconds, 50) else None,
+            'peak_rss_mb': max(run[stage]['peak_rss_mb'] for run in runs),
+            'children_peak_rss_mb': max(run[stage]['children_peak_rss_mb'] for run in runs),
+        }
+        for key, value in runs[-1][stage].items():
+            if key not in ('seconds', 'items', 'peak_rss_mb', 'children_peak_rss_mb'):
+                summary[stage][key] = value
+    return summary
+
+
+def print_summary(size, summary, repeat):
+    #with a handful of runs p99 is effectively the slowest run
+    print(f"\n== {size} applicants, {repeat} run(s){'' if repeat >= 5 else ', p99 ~ slowest run'} ==")
+    print(f"{'stage':<10}{'items':>8}{'p50 s':>10}{'p99 s':>10}{'items/s':>12}{'peak RSS MB':>14}{'workers MB':>12}  extra")
+    for stage, row in summary.items():
+        extra = {k: (round(v, 2) if isinstance(v, float) else v) for k, v in row.items()
+                 if k not in ('items', 'p50_seconds', 'p99_seconds', 'items_per_second', 'peak_rss_mb', 'children_peak_rss_mb')}
+        rate = f"{row['items_per_second']:.0f}" if row['items_per_second'] else '-'
+        print(f"{stage:<10}{row['items'] or 0:>8}{row['p50_seconds']:>10.3f}{row['p99_seconds']:>10.3f}{rate:>12}{row['peak_rss_mb']:>14.1f}"
+              f"{row['children_peak_rss_mb']:>12.1f}  {extra if extra else ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the geolocate pipeline offline against a mock geocoder")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000, 20000], help="applicant counts to benchmark")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per size, for p50/p99 of stage times")
+    parser.add_argument('--max-photos', type=int, default=2000, help="cap on synthetic photo PDFs per size")
+    parser.add_argument('--latency', type=float, default=0.02, help="mock geocoder latency per request, seconds")
+    parser.add_argument('--jitter', type=float, default=0.01, help="mock geocoder extra random latency, seconds")
+    parser.add_argument('--error-rate', type=float, default=0.01, help="fraction of mock requests answered with HTTP 500")
+    parser.add_argument('--server-qps', type=float, default=None, help="mock geocoder answers HTTP 429 above this rate")
+    parser.add_argument('--workers', type=int, default=16, help="geocoding threads")
+    parser.add_argument('--qps', type=float, default=1000, help="client-side rate limit")
+    parser.add_argument('--lightweight', action='store_true', help="benchmark the lightweight marker layer")
+    parser.add_argument('--aggregate', action='store_true', help="benchmark the aggregate (heatmap) map instead of markers")
+    parser.add_argument('--precision', type=int, default=GEOHASH_PRECISION, help="geohash precision of the aggregate areas")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    server = start_mock_geocoder(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, qps=args.server_qps)
+    report = {'options': vars(args), 'sizes': {}}
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for size in args.sizes:
+                csv_bytes = synthetic_applicants_csv(size)
+                pdfs = synthetic_photo_pdfs(range(10000000, 10000000 + min(size, args.max_photos)))
+                runs = [run_pipeline(csv_bytes, pdfs, server.geocode_url, args, workdir) for _ in range(args.repeat)]
+                summary = summarize(runs)
+                report['sizes'][size] = summary
+                print_summary(size, summary, args.repeat)
+    finally:
+        server.shutdown()
+    report['mock_status_counts'] = server.status_counts
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
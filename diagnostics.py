@@ -0,0 +1,84 @@
+#####RUN DIAGNOSTICS: STAGE TIMERS, GEOCODING API USAGE, BYTES PRODUCED#####
+# One plain dict per run so the app can show it in a panel and the CLI can dump it as JSON
+# next to the maps, to compare runs across application cycles.
+import json
+import platform
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+
+
+# upper bounds of the request latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = [25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+
+def new_diagnostics():
+    return {
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'stages': {},
+        'geocode': None,
+        'bytes': {},
+        'errors': [],
+    }
+
+
+# TIME A PIPELINE STAGE INTO diagnostics['stages'] (seconds, also recorded when the stage fails)
+# accumulate adds to the stage's time so far, for stages run once per chunk
+@contextmanager
+def timed_stage(diagnostics, stage, accumulate=False):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        if accumulate:
+            seconds += diagnostics['stages'].get(stage, 0)
+        diagnostics['stages'][stage] = round(seconds, 4)
+
+
+def record_error(diagnostics, stage, error):
+    diagnostics['errors'].append({'stage': stage, 'type': type(error).__name__, 'message': str(error)})
+
+
+# COUNT, PERCENTILES AND HISTOGRAM OF REQUEST LATENCIES (seconds in, milliseconds out)
+def latency_summary(latencies):
+    if not len(latencies):
+        return {'count': 0}
+    latencies_ms = np.asarray(latencies) * 1000
+    counts = np.bincount(np.searchsorted(LATENCY_BUCKETS_MS, latencies_ms), minlength=len(LATENCY_BUCKETS_MS) + 1)
+    labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+    return {
+        'count': len(latencies_ms),
+        'p50_ms': round(float(np.percentile(latencies_ms, 50)), 1),
+        'p90_ms': round(float(np.percentile(latencies_ms, 90)), 1),
+        'p99_ms': round(float(np.percentile(latencies_ms, 99)), 1),
+        'max_ms': round(float(latencies_ms.max()), 1),
+        'histogram': {label: int(count) for label, count in zip(labels, counts)},
+    }
+
+
+# new_geocode_stats() -> JSON friendly summary with hit rates instead of raw latencies
+def geocode_summary(stats, reused=0):
+    looked_up = stats['hits'] + stats['misses']
+    return {
+        'rows': stats['rows'],
+        'reused_from_previous_run': reused,
+        'unique_addresses': stats['unique'],
+        'dedup_saved': stats['rows'] - stats['unique'],
+        'cache_hits': stats['hits'],
+        'cache_misses': stats['misses'],
+        'cache_hit_rate': round(stats['hits'] / looked_up, 3) if looked_up else None,
+        'requests': stats['requests'],
+        'retries': stats['retries'],
+        'status_codes': {str(code): count for code, count in sorted(stats['status_codes'].items())},
+        'api_statuses': dict(sorted(stats['api_statuses'].items())),
+        'errors': dict(sorted(stats['errors'].items())),
+        'latency': latency_summary(stats['latencies']),
+    }
+
+
+def diagnostics_json(diagnostics):
+    return json.dumps(diagnostics, indent=2)
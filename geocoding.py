@@ -0,0 +1,243 @@
+#####GEOCODE APPLICANT ADDRESSES#####
+import hashlib
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+from applicants import normalize_addresses
+
+
+# GEOCODING SETTINGS
+GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+GEOCODE_MAX_WORKERS = 8
+GEOCODE_QPS = 40  # Google allows 50 requests per second
+GEOCODE_MAX_RETRIES = 4
+GEOCODE_TIMEOUT = 10  # seconds
+
+# GEOCODE CACHE ON DISK
+# keyed on a hash of the normalized address so no address text is stored
+GEOCODE_CACHE_PATH = "geocode_cache.sqlite3"
+GEOCODE_CACHE_TTL = 180 * 24 * 60 * 60  # seconds before a cached coordinate is looked up again
+GEOCODE_CACHE_MAX_ENTRIES = 100000
+GEOCODE_CACHE_COMMIT_EVERY = 50  # writes per transaction, so other processes never wait on a whole run
+# only these answers are final; quota, denied and invalid requests must be asked again next time
+GEOCODE_CACHEABLE_STATUSES = ('OK', 'ZERO_RESULTS')
+# bumped when entries written by older versions can't be trusted
+GEOCODE_CACHE_VERSION = 1
+
+
+# rows/unique/hits/misses count addresses; the rest count HTTP attempts, retries included
+def new_geocode_stats():
+    return {
+        'rows': 0, 'unique': 0, 'hits': 0, 'misses': 0,
+        'requests': 0, 'retries': 0, 'status_codes': {}, 'api_statuses': {}, 'errors': {}, 'latencies': [],
+        #normalized addresses seen so far, so 'unique' stays right when one stats dict spans several calls (CSV chunks)
+        'address_keys': set(),
+    }
+
+
+# FOLD THE ATTEMPTS OF ONE LOOKUP INTO stats (called from the main thread only)
+def record_attempts(stats, attempts):
+    #every attempt after a lookup's first is a retry
+    stats['retries'] += max(len(attempts) - 1, 0)
+    for latency, status_code, api_status, error in attempts:
+        stats['requests'] += 1
+        stats['latencies'].append(latency)
+        if status_code is not None:
+            stats['status_codes'][status_code] = stats['status_codes'].get(status_code, 0) + 1
+        if api_status is not None:
+            stats['api_statuses'][api_status] = stats['api_statuses'].get(api_status, 0) + 1
+        if error is not None:
+            stats['errors'][error] = stats['errors'].get(error, 0) + 1
+
+
+# other endpoints (a mock_geocoder.py, a proxy) get their own keys so their answers never reach Google runs;
+# Google's keys stay as they were so existing cache files keep working
+def geocode_cache_key(address_key, base_url=GEOCODE_URL):
+    if base_url != GEOCODE_URL:
+        address_key = base_url + '\0' + address_key
+    return hashlib.sha256(address_key.encode('utf-8')).hexdigest()
+
+
+def open_geocode_cache(path=GEOCODE_CACHE_PATH):
+    #timeout lets several CLI processes and app sessions share one cache file; with WAL readers never
+    #wait for a writer and writers only wait for each other's short batches
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS geocode (key TEXT PRIMARY KEY, lat REAL, lng REAL, created REAL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS geocode_created ON geocode (created)")
+    if conn.execute("PRAGMA user_version").fetchone()[0] < GEOCODE_CACHE_VERSION:
+        #the first cache stored OVER_QUERY_LIMIT/REQUEST_DENIED answers as "no result", so drop every no-result entry once
+        conn.execute("DELETE FROM geocode WHERE lat IS NULL")
+        conn.execute(f"PRAGMA user_version = {GEOCODE_CACHE_VERSION}")
+        conn.commit()
+    return conn
+
+
+def evict_geocode_cache(conn):
+    #drop expired entries then trim the oldest ones past the size limit
+    conn.execute("DELETE FROM geocode WHERE created < ?", (time.time() - GEOCODE_CACHE_TTL,))
+    conn.execute(
+        "DELETE FROM geocode WHERE key IN (SELECT key FROM geocode ORDER BY created DESC LIMIT -1 OFFSET ?)",
+        (GEOCODE_CACHE_MAX_ENTRIES,)
+    )
+    conn.commit()
+
+
+def read_geocode_cache(conn, address_key, base_url=GEOCODE_URL):
+    row = conn.execute(
+        "SELECT lat, lng FROM geocode WHERE key = ? AND created >= ?",
+        (geocode_cache_key(address_key, base_url), time.time() - GEOCODE_CACHE_TTL)
+    ).fetchone()
+    return row
+
+
+def write_geocode_cache(conn, address_key, lat, lng, base_url=GEOCODE_URL):
+    conn.execute(
+        "INSERT OR REPLACE INTO geocode (key, lat, lng, created) VALUES (?, ?, ?, ?)",
+        (geocode_cache_key(address_key, base_url), lat, lng, time.time())
+    )
+
+
+# TOKEN BUCKET SHARED BY ALL GEOCODING THREADS
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# FUNCTION TO GET COORDINATES FROM GOOGLE MAPS (or any server speaking its geocode JSON)
+# returns (lat, lng, cacheable, attempts); transient failures are not cacheable and attempts holds
+# (latency seconds, HTTP status, API status, error) for every request made, for record_attempts()
+def extract_lat_long_via_address(session, limiter, api_key, address_or_zipcode, base_url=GEOCODE_URL):
+    attempts = []
+    for attempt in range(GEOCODE_MAX_RETRIES + 1):
+        if attempt:
+            time.sleep(min(30, 0.5 * 2 ** attempt) + random.uniform(0, 0.5))
+        limiter.acquire()
+        started = time.perf_counter()
+        try:
+            r = session.get(base_url, params={'address': address_or_zipcode, 'key': api_key}, timeout=GEOCODE_TIMEOUT)
+        except requests.RequestException as e:
+            attempts.append((time.perf_counter() - started, None, None, type(e).__name__))
+            continue
+        latency = time.perf_counter() - started
+        if r.status_code == 429 or r.status_code >= 500:
+            attempts.append((latency, r.status_code, None, None))
+            continue
+        if r.status_code not in range(200, 299):
+            attempts.append((latency, r.status_code, None, None))
+            return None, None, False, attempts
+        try:
+            payload = r.json()
+        except ValueError:
+            attempts.append((latency, r.status_code, None, 'InvalidJSON'))
+            return None, None, False, attempts
+        status = payload.get('status')
+        attempts.append((latency, r.status_code, status, None))
+        if status == 'OVER_QUERY_LIMIT' or status == 'UNKNOWN_ERROR':
+            continue
+        if status not in GEOCODE_CACHEABLE_STATUSES:
+            #REQUEST_DENIED, INVALID_REQUEST: no answer for this address, and not one to remember
+            return None, None, False, attempts
+        if status == 'ZERO_RESULTS':
+            return None, None, True, attempts
+        try:
+            location = payload['results'][0]['geometry']['location']
+            return location['lat'], location['lng'], True, attempts
+        except (KeyError, IndexError):
+            attempts[-1] = (latency, r.status_code, status, 'MissingLocation')
+            return None, None, False, attempts
+    return None, None, False, attempts
+
+
+# GEOCODE A COLUMN OF ADDRESSES CONCURRENTLY AND RETURN A lat/lng FRAME WITH THE SAME INDEX
+# each normalized address is looked up once and broadcast back to every row that shares it
+# cache is an open_geocode_cache() connection or None, progress wraps the completed futures (e.g. stqdm)
+def geocode_addresses(addresses, api_key, base_url=GEOCODE_URL, cache=None, stats=None,
+                      max_workers=GEOCODE_MAX_WORKERS, qps=GEOCODE_QPS, progress=None):
+    stats = stats if stats is not None else new_geocode_stats()
+    address_keys = normalize_addresses(addresses)
+    #first spelling of each key is what gets sent to Google
+    lookups = addresses.groupby(address_keys, sort=False).first()
+    stats['rows'] += len(addresses)
+    seen = len(stats['address_keys'])
+    stats['address_keys'].update(lookups.index)
+    stats['unique'] += len(stats['address_keys']) - seen
+
+    coords = {}
+    pending = []
+    for address_key in lookups.index:
+        if cache is not None:
+            cached = read_geocode_cache(cache, address_key, base_url)
+            if cached is not None:
+                stats['hits'] += 1
+                coords[address_key] = cached
+                continue
+            stats['misses'] += 1
+        pending.append(address_key)
+
+    if pending:
+        limiter = RateLimiter(qps)
+        with requests.Session() as session, ThreadPoolExecutor(max_workers=max_workers) as pool:
+            #keep-alive connections, one per worker
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            futures = {
+                pool.submit(extract_lat_long_via_address, session, limiter, api_key, lookups[address_key], base_url): address_key
+                for address_key in pending
+            }
+            completed = as_completed(futures)
+            pending_writes = 0
+            if progress is not None:
+                completed = progress(completed, total=len(futures))
+            try:
+                for future in completed:
+                    address_key = futures[future]
+                    lat, lng, cacheable, attempts = future.result()
+                    record_attempts(stats, attempts)
+                    coords[address_key] = (lat, lng)
+                    #addresses Google could not resolve are cached too so unchanged uploads make no calls
+                    if cache is not None and cacheable:
+                        write_geocode_cache(cache, address_key, lat, lng, base_url)
+                        pending_writes += 1
+                        if pending_writes >= GEOCODE_CACHE_COMMIT_EVERY:
+                            cache.commit()
+                            pending_writes = 0
+            except BaseException:
+                #drop the queued lookups instead of waiting for all of them in the pool's __exit__
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+            finally:
+                #keep what was already resolved, even when the run is interrupted
+                if cache is not None:
+                    cache.commit()
+
+    return pd.DataFrame(
+        [coords[address_key] for address_key in address_keys],
+        index=addresses.index,
+        columns=['lat', 'lng'],
+        dtype='float64'
+    )
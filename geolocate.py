@@ -0,0 +1,290 @@
+#####HEADLESS GEOLOCATE PIPELINE AND CLI#####
+# The Streamlit app (stream_app.py) is a front end over these functions; the CLI runs the same
+# pipeline in batch, e.g. from a cron job precomputing maps for several programs:
+#
+#   python geolocate.py map program_a.csv program_b.csv --out-dir maps/ --lightweight --diagnostics maps/diagnostics.json
+#   python geolocate.py aggregate maps/*.geocoded.csv --out maps/all_programs.html --precision 3
+#   python geolocate.py photos bulk_print/*.pdf --out photos.zip --thumbnail 200
+#
+# GOOGLE_API_KEY is read from the environment unless --api-key is given.
+# folium, PyPDF2 and PIL are only imported by the command that needs them.
+import argparse
+import json
+import os
+import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from applicants import CATEGORICAL_HEADERS, read_applicants, missing_required_headers, prepare_applicants, read_previous_run, reuse_previous_coordinates
+from geocoding import (
+    GEOCODE_URL, GEOCODE_MAX_WORKERS, GEOCODE_QPS, GEOCODE_CACHE_PATH, new_geocode_stats,
+    open_geocode_cache, evict_geocode_cache, geocode_addresses
+)
+from diagnostics import new_diagnostics, timed_stage, geocode_summary
+
+
+# GEOCODE AN APPLICANT FRAME, REUSING COORDINATES FROM A PREVIOUS RUN WHEN GIVEN
+# returns (geo_df with lat/lng joined on, number of applicants whose coordinates were reused)
+# geocode_options are passed through to geocode_addresses (api_key, base_url, cache, stats, ...)
+def geocode_applicants(df, previous=None, **geocode_options):
+    df = df.dropna(subset=['Permanent Address'])
+    if previous is None:
+        return df.join(geocode_addresses(df['Permanent Address'], **geocode_options)), 0
+    coords = reuse_previous_coordinates(df, previous)
+    changed = coords['lat'].isna()
+    coords.loc[changed, ['lat', 'lng']] = geocode_addresses(df.loc[changed, 'Permanent Address'], **geocode_options)
+    return df.join(coords), int((~changed).sum())
+
+
+# AGGREGATE MAP AT html_path PLUS <name>.cells.csv AND <name>.regions.csv NEXT TO IT
+# the CSVs are the precomputed aggregates, small enough to keep and compare across cycles
+def save_aggregate_map(geo_df, html_path, precision, diagnostics):
+    from aggregation import GEOHASH_PRECISION, aggregate_cells, aggregate_regions
+    from applicant_map import build_aggregate_map
+
+    precision = precision or GEOHASH_PRECISION
+    prefix = os.path.splitext(html_path)[0]
+    with timed_stage(diagnostics, 'aggregate'):
+        cells = aggregate_cells(geo_df, precision)
+        regions = aggregate_regions(geo_df)
+    cells.to_csv(f"{prefix}.cells.csv", index=False)
+    regions.to_csv(f"{prefix}.regions.csv", index=False)
+    diagnostics['aggregate'] = {'precision': precision, 'cells': len(cells), 'regions': len(regions)}
+    with timed_stage(diagnostics, 'build_map'):
+        m = build_aggregate_map(cells)
+    with timed_stage(diagnostics, 'save_html'):
+        m.save(html_path)
+
+
+# CSV -> geo_applicants HTML (and the geocoded CSV for the next incremental run) FOR ONE PROGRAM
+# aggregate draws counts per geohash area of the given precision (None = default) instead of markers
+# chunksize reads and geocodes the CSV that many rows at a time, so the raw export is never in memory at once
+def build_program_map(csv_path, out_dir, api_key, base_url=GEOCODE_URL, cache_path=GEOCODE_CACHE_PATH,
+                      max_workers=GEOCODE_MAX_WORKERS, qps=GEOCODE_QPS, lightweight=False, photos=False, incremental=True,
+                      aggregate=False, precision=None, chunksize=None):
+    from applicant_map import image_sources, build_map
+
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    html_path = os.path.join(out_dir, f"{name}.html")
+    geocoded_path = os.path.join(out_dir, f"{name}.geocoded.csv")
+
+    if chunksize and not cache_path:
+        #nothing carries coordinates from one chunk to the next
+        print(f"WARNING {csv_path}: --chunksize without the geocode cache looks up addresses repeated across chunks again", file=sys.stderr)
+    diagnostics = new_diagnostics()
+    diagnostics['csv'] = csv_path
+    with timed_stage(diagnostics, 'read_csv', accumulate=True):
+        chunks = read_applicants(csv_path, chunksize=chunksize) if chunksize else iter([read_applicants(csv_path)])
+    previous = read_previous_run(geocoded_path) if incremental and os.path.exists(geocoded_path) else None
+
+    stats = new_geocode_stats()
+    cache = None
+    if cache_path:
+        cache = open_geocode_cache(cache_path)
+        evict_geocode_cache(cache)
+    applicants = 0
+    reused = 0
+    geo_chunks = []
+    try:
+        while True:
+            with timed_stage(diagnostics, 'read_csv', accumulate=True):
+                df = next(chunks, None)
+            if df is None:
+                break
+            set_diff = missing_required_headers(df)
+            if set_diff:
+                raise ValueError(f"{csv_path}: required column header name(s) are missing to process: {set_diff}")
+            df = prepare_applicants(df)
+            applicants += len(df)
+            #duplicate addresses in different chunks are looked up once only when the cache is on,
+            #but stats count each unique address once either way
+            with timed_stage(diagnostics, 'geocode', accumulate=True):
+                geo_chunk, chunk_reused = geocode_applicants(
+                    df, previous, api_key=api_key, base_url=base_url, cache=cache, stats=stats, max_workers=max_workers, qps=qps
+                )
+            geo_chunks.append(geo_chunk)
+            reused += chunk_reused
+    finally:
+        if cache is not None:
+            cache.close()
+    diagnostics['geocode'] = geocode_summary(stats, reused)
+    if not geo_chunks:
+        raise ValueError(f"{csv_path}: no applicants in the file")
+    #chunks each have their own categories, so the columns are made categorical again after joining
+    geo_df = pd.concat(geo_chunks)
+    geo_df = geo_df.astype({column: 'category' for column in CATEGORICAL_HEADERS if column in geo_df})
+
+    geo_df.to_csv(geocoded_path, index=False)
+    mapped = geo_df.dropna(subset=['lat'])
+    if mapped.empty:
+        raise ValueError(f"{csv_path}: no applicant could be geocoded")
+    if aggregate:
+        save_aggregate_map(mapped, html_path, precision, diagnostics)
+    else:
+        image_srcs = image_sources(mapped['AAMC ID']) if photos else None
+        with timed_stage(diagnostics, 'build_map'):
+            m = build_map(mapped, lightweight=lightweight, image_srcs=image_srcs)
+        with timed_stage(diagnostics, 'save_html'):
+            m.save(html_path)
+    diagnostics['bytes'] = {
+        'upload_csv': os.path.getsize(csv_path),
+        'geocoded_csv': os.path.getsize(geocoded_path),
+        'map_html': os.path.getsize(html_path),
+    }
+    return {
+        'csv': csv_path,
+        'html': html_path,
+        'applicants': applicants,
+        'mapped': len(mapped),
+        'reused': reused,
+        'unique': stats['unique'],
+        'hits': stats['hits'],
+        'misses': stats['misses'],
+        'diagnostics': diagnostics,
+    }
+
+
+def run_map_command(args):
+    api_key = args.api_key or os.environ.get('GOOGLE_API_KEY')
+    if not api_key:
+        sys.exit("Set GOOGLE_API_KEY or pass --api-key")
+    os.makedirs(args.out_dir, exist_ok=True)
+    jobs = min(args.jobs or os.cpu_count() or 1, len(args.csv))
+    options = dict(
+        out_dir=args.out_dir,
+        api_key=api_key,
+        base_url=args.geocode_url,
+        cache_path=None if args.no_cache else args.cache,
+        max_workers=args.workers,
+        #the Google quota is shared by every program processed at once
+        qps=args.qps / jobs,
+        lightweight=args.lightweight,
+        photos=args.photos,
+        incremental=not args.full,
+        aggregate=args.aggregate,
+        precision=args.precision,
+        chunksize=args.chunksize,
+    )
+    failed = False
+    diagnostics = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [(csv_path, pool.submit(build_program_map, csv_path, **options)) for csv_path in args.csv]
+        for csv_path, future in futures:
+            try:
+                result = future.result()
+            except Exception as e:
+                failed = True
+                print(f"FAILED {csv_path}: {e}", file=sys.stderr)
+                continue
+            print(
+                f"{result['html']}: mapped {result['mapped']}/{result['applicants']} applicants, "
+                f"{result['reused']} reused, {result['unique']} unique lookups, {result['hits']} cache hits, "
+                f"{result['diagnostics']['geocode']['requests']} requests"
+            )
+            diagnostics.append(result['diagnostics'])
+    if args.diagnostics:
+        with open(args.diagnostics, 'w') as f:
+            json.dump(diagnostics, f, indent=2)
+    if failed:
+        sys.exit(1)
+
+
+# ONE AGGREGATE MAP OVER SEVERAL PROGRAMS' GEOCODED CSVs, no geocoding needed
+def run_aggregate_command(args):
+    diagnostics = new_diagnostics()
+    with timed_stage(diagnostics, 'read_csv'):
+        geo_df = pd.concat([read_previous_run(path) for path in args.geocoded], ignore_index=True)
+    if geo_df.empty:
+        sys.exit("No geocoded applicants in the given files")
+    save_aggregate_map(geo_df, args.out, args.precision, diagnostics)
+    diagnostics['bytes'] = {'map_html': os.path.getsize(args.out)}
+    print(
+        f"{args.out}: {len(geo_df)} applicants from {len(args.geocoded)} file(s) in "
+        f"{diagnostics['aggregate']['cells']} areas and {diagnostics['aggregate']['regions']} countries/states"
+    )
+    if args.diagnostics:
+        with open(args.diagnostics, 'w') as f:
+            json.dump(diagnostics, f, indent=2)
+
+
+def run_photos_command(args):
+    from pdf_photos import zip_pdf_images, photo_name
+
+    thumbnail = None
+    if args.thumbnail:
+        per_image_budget = int(args.budget_mb * 1024 * 1024 / len(args.pdf))
+        thumbnail = (args.thumbnail, args.quality, per_image_budget)
+
+    def read_pdf(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def show_messages(images, messages, counts):
+        for level, text in messages:
+            print(f"{level.upper()}: {text}", file=sys.stderr)
+
+    diagnostics = new_diagnostics()
+    pdf_jobs = [(path, photo_name(path), (lambda path=path: read_pdf(path))) for path in args.pdf]
+    with timed_stage(diagnostics, 'extract_photos'), zipfile.ZipFile(args.out, "w") as zipf:
+        totals = zip_pdf_images(zipf, pdf_jobs, thumbnail=thumbnail, max_workers=args.jobs, on_result=show_messages)
+    print(
+        f"{args.out}: {totals['images']} image(s), {totals['bytes'] / 1024 / 1024:.1f} MB "
+        f"({totals['copied']} copied, {totals['reencoded']} re-encoded, {totals['thumbnails']} thumbnails)"
+    )
+    if args.diagnostics:
+        diagnostics['photos'] = {key: totals[key] for key in ('images', 'copied', 'reencoded', 'thumbnails')}
+        diagnostics['bytes'] = {'photo_images': totals['bytes'], 'photo_zip': os.path.getsize(args.out)}
+        with open(args.diagnostics, 'w') as f:
+            json.dump(diagnostics, f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='geolocate', description="Geolocate ERAS applicants without the Streamlit app")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    map_parser = commands.add_parser('map', help="geocode ERAS CSV exports and save one map per CSV")
+    map_parser.add_argument('csv', nargs='+', help="ERAS CSV export(s), one per program")
+    map_parser.add_argument('--out-dir', default='.', help="where <name>.html and <name>.geocoded.csv are written")
+    map_parser.add_argument('--api-key', help="Google geocoding API key (default: $GOOGLE_API_KEY)")
+    map_parser.add_argument('--geocode-url', default=GEOCODE_URL, help="geocoder endpoint, e.g. a mock_geocoder.py URL")
+    map_parser.add_argument('--cache', default=GEOCODE_CACHE_PATH, help="SQLite geocode cache file")
+    map_parser.add_argument('--no-cache', action='store_true', help="don't read or write the geocode cache")
+    map_parser.add_argument('--full', action='store_true', help="ignore <name>.geocoded.csv from a previous run")
+    map_parser.add_argument('--jobs', type=int, help="programs processed in parallel (default: all cores)")
+    map_parser.add_argument('--workers', type=int, default=GEOCODE_MAX_WORKERS, help="geocoding threads per program")
+    map_parser.add_argument('--qps', type=float, default=GEOCODE_QPS, help="total geocoding requests per second")
+    map_parser.add_argument('--lightweight', action='store_true', help="use the lightweight marker layer")
+    map_parser.add_argument('--photos', action='store_true', help="show <AAMC ID>.jpg photos in the popups")
+    map_parser.add_argument('--chunksize', type=int, help="read and geocode the CSV this many rows at a time (default: all at once)")
+    map_parser.add_argument('--aggregate', action='store_true', help="draw a heatmap with counts per area instead of markers")
+    map_parser.add_argument('--precision', type=int, choices=range(1, 13), metavar='1-12',
+                            help="geohash precision of the aggregate areas (default: 4, about 39 x 20 km; 3 is about 156 km)")
+    map_parser.add_argument('--diagnostics', help="write stage timings and geocoding request stats to this JSON file")
+    map_parser.set_defaults(func=run_map_command)
+
+    aggregate_parser = commands.add_parser('aggregate', help="combine geocoded CSVs from 'map' runs into one aggregate map")
+    aggregate_parser.add_argument('geocoded', nargs='+', help="<name>.geocoded.csv (or .parquet) files")
+    aggregate_parser.add_argument('--out', default='geo_applicants_aggregate.html', help="HTML file; .cells.csv and .regions.csv are written next to it")
+    aggregate_parser.add_argument('--precision', type=int, choices=range(1, 13), metavar='1-12',
+                            help="geohash precision of the aggregate areas (default: 4, about 39 x 20 km; 3 is about 156 km)")
+    aggregate_parser.add_argument('--diagnostics', help="write stage timings to this JSON file")
+    aggregate_parser.set_defaults(func=run_aggregate_command)
+
+    photos_parser = commands.add_parser('photos', help="extract applicant photos from ERAS bulk print PDFs into a ZIP")
+    photos_parser.add_argument('pdf', nargs='+', help="photograph PDFs")
+    photos_parser.add_argument('--out', default='converted_images.zip')
+    photos_parser.add_argument('--jobs', type=int, help="extraction processes (default: all cores)")
+    photos_parser.add_argument('--thumbnail', type=int, help="shrink photos to at most this many pixels wide/high")
+    photos_parser.add_argument('--quality', type=int, default=80, help="thumbnail JPEG quality")
+    photos_parser.add_argument('--budget-mb', type=float, default=0, help="total thumbnail size budget in MB (0 = none)")
+    photos_parser.add_argument('--diagnostics', help="write stage timings and output sizes to this JSON file")
+    photos_parser.set_defaults(func=run_photos_command)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
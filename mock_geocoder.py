@@ -0,0 +1,122 @@
+#####LOCAL STAND-IN FOR THE GOOGLE GEOCODING API#####
+# Serves the same JSON shape as maps.googleapis.com/maps/api/geocode/json so the app and
+# benchmark.py can run without network access or an API key.
+#
+#   python mock_geocoder.py --port 8765 --latency 0.05 --error-rate 0.02 --qps 50
+#
+# then point the app at it with GEOCODE_URL = "http://127.0.0.1:8765/maps/api/geocode/json" in secrets.toml
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+# addresses containing this text come back as ZERO_RESULTS
+UNKNOWN_ADDRESS_MARKER = 'nowhere'
+
+
+# DETERMINISTIC COORDINATES INSIDE THE CONTINENTAL US FOR AN ADDRESS
+def fake_location(address):
+    digest = hashlib.md5(address.lower().encode('utf-8')).digest()
+    lat = 25 + int.from_bytes(digest[:4], 'big') / 2 ** 32 * 23
+    lng = -124 + int.from_bytes(digest[4:8], 'big') / 2 ** 32 * 57
+    return {'lat': round(lat, 7), 'lng': round(lng, 7)}
+
+
+class MockGeocoderHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like Google
+
+    def do_GET(self):
+        server = self.server
+        if server.latency or server.jitter:
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+        if server.over_quota():
+            return self.send_json(429, {'status': 'OVER_QUERY_LIMIT', 'results': []})
+        if server.error_rate and random.random() < server.error_rate:
+            return self.send_json(500, {'status': 'UNKNOWN_ERROR', 'results': []})
+
+        address = parse_qs(urlparse(self.path).query).get('address', [''])[0]
+        if not address or UNKNOWN_ADDRESS_MARKER in address.lower():
+            return self.send_json(200, {'status': 'ZERO_RESULTS', 'results': []})
+        self.send_json(200, {
+            'status': 'OK',
+            'results': [{'formatted_address': address, 'geometry': {'location': fake_location(address)}}],
+        })
+
+    def send_json(self, status_code, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.status_counts[status_code] = self.server.status_counts.get(status_code, 0) + 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockGeocoderServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # latency and jitter in seconds, error_rate is the fraction of 500s, qps (None = unlimited) triggers 429s
+    def __init__(self, address, latency=0.0, jitter=0.0, error_rate=0.0, qps=None):
+        super().__init__(address, MockGeocoderHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.qps = qps
+        self.lock = threading.Lock()
+        self.recent = deque()
+        self.status_counts = {}
+
+    def over_quota(self):
+        if not self.qps:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            while self.recent and now - self.recent[0] > 1:
+                self.recent.popleft()
+            if len(self.recent) >= self.qps:
+                return True
+            self.recent.append(now)
+            return False
+
+    @property
+    def geocode_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/maps/api/geocode/json"
+
+
+# START A MOCK SERVER ON A BACKGROUND THREAD; port 0 picks a free port
+# call server.shutdown() when done
+def start_mock_geocoder(port=0, **options):
+    server = MockGeocoderServer(('127.0.0.1', port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Google geocoding API")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="extra random latency, up to this many seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with HTTP 500")
+    parser.add_argument('--qps', type=float, default=None, help="answer with HTTP 429 above this many requests per second")
+    args = parser.parse_args()
+    server = MockGeocoderServer(('127.0.0.1', args.port), latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, qps=args.qps)
+    print(f"Mock geocoder listening on {server.geocode_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
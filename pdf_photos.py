@@ -0,0 +1,239 @@
+#####EXTRACT APPLICANT PHOTOS FROM ERAS PDFs#####
+# Lives outside stream_app.py so the worker function can be pickled into a process pool
+import multiprocessing
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from importlib.machinery import ModuleSpec
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from io import BytesIO
+
+from PyPDF2 import PdfReader
+from PIL import Image, UnidentifiedImageError
+
+
+# NUMBER OF COLOR COMPONENTS OF AN IMAGE /ColorSpace, 0 when it can't be told
+DEVICE_COLOR_COMPONENTS = {'/DeviceGray': 1, '/CalGray': 1, '/DeviceRGB': 3, '/CalRGB': 3, '/Lab': 3, '/DeviceCMYK': 4}
+
+def color_components(color_space):
+    color_space = color_space.get_object() if color_space is not None else None
+    if isinstance(color_space, list):
+        family = color_space[0]
+        if family == '/ICCBased':
+            return int(color_space[1].get_object().get('/N', 0))
+        if family == '/DeviceN':
+            return len(color_space[1].get_object())
+        if family in ('/Indexed', '/Separation'):
+            return 1
+        return DEVICE_COLOR_COMPONENTS.get(family, 0)
+    return DEVICE_COLOR_COMPONENTS.get(color_space, 0)
+
+
+def last_filter(img):
+    filters = img.get('/Filter')
+    if isinstance(filters, list):
+        return filters[-1] if filters else None
+    return filters
+
+
+# PIL IMAGE FROM AN IMAGE XObject AND ITS get_data() BYTES
+# JPEG, JPEG 2000 and CCITT (which PyPDF2 wraps in a TIFF header) are still encoded and PIL opens them; anything else (Flate, LZW, raw)
+# comes back as packed samples and is rebuilt from /Width, /Height, /BitsPerComponent and the color space
+RAW_IMAGE_MODES = {1: 'L', 3: 'RGB', 4: 'CMYK'}
+
+def pdf_image(img, img_data):
+    if last_filter(img) in ('/DCTDecode', '/JPXDecode', '/CCITTFaxDecode'):
+        return Image.open(BytesIO(img_data))
+    if img.get('/ImageMask'):
+        raise UnidentifiedImageError("image masks have no color to extract")
+    size = (int(img['/Width']), int(img['/Height']))
+    bits = int(img.get('/BitsPerComponent', 8))
+    color_space = img.get('/ColorSpace')
+    color_space = color_space.get_object() if color_space is not None else None
+    if bits == 16:
+        #keep the high byte of every sample
+        img_data, bits = img_data[::2], 8
+
+    if isinstance(color_space, list) and color_space[0] == '/Indexed':
+        base_components = color_components(color_space[1])
+        lookup = color_space[3].get_object()
+        lookup = lookup.get_data() if hasattr(lookup, 'get_data') else bytes(lookup)
+        if base_components not in RAW_IMAGE_MODES:
+            raise UnidentifiedImageError(f"unsupported /Indexed base color space with {base_components} components")
+        palette = Image.frombytes(RAW_IMAGE_MODES[base_components], (len(lookup) // base_components, 1), lookup)
+        palette = palette.convert('RGB').tobytes()
+        img_pil = Image.frombytes('P', size, img_data, 'raw', 'P' if bits == 8 else f'P;{bits}')
+        img_pil.putpalette(palette)
+        return img_pil.convert('RGB')
+
+    components = color_components(color_space)
+    if components not in RAW_IMAGE_MODES or (bits != 8 and components != 1):
+        raise UnidentifiedImageError(f"unsupported raw image: {components} component(s) at {bits} bits")
+    if bits == 1:
+        img_pil = Image.frombytes('1', size, img_data).convert('L')
+    else:
+        mode = RAW_IMAGE_MODES[components]
+        img_pil = Image.frombytes(mode, size, img_data, 'raw', mode if bits == 8 else f'L;{bits}')
+    #a /Decode array starting [1 0] means the samples are stored inverted (e.g. white-is-zero scans)
+    decode = img.get('/Decode')
+    if decode is not None and len(decode) >= 2 and float(decode[0]) > float(decode[1]):
+        img_pil = Image.eval(img_pil, lambda value: 255 - value)
+    return img_pil
+
+
+# IMAGES WHOSE LAST FILTER IS DCTDecode ARE ALREADY JPEGs AND ARE COPIED AS-IS
+# CMYK JPEGs (/DeviceCMYK or a 4-component /ICCBased profile) are still re-encoded since browsers render them inconsistently
+def is_jpeg_stream(img):
+    return last_filter(img) == '/DCTDecode' and color_components(img.get('/ColorSpace')) != 4
+
+
+# DOWNSAMPLE TO FIT max_px AND LOWER JPEG QUALITY UNTIL THE RESULT FITS max_bytes (0 = no limit)
+THUMBNAIL_MIN_QUALITY = 30
+
+def make_thumbnail(img_pil, max_px, quality, max_bytes=0):
+    # let the JPEG decoder scale down while decoding when it can
+    img_pil.draft('RGB', (max_px, max_px))
+    if img_pil.mode not in ('RGB', 'L'):
+        img_pil = img_pil.convert('RGB')
+    img_pil.thumbnail((max_px, max_px))
+    while True:
+        img_io = BytesIO()
+        img_pil.save(img_io, 'JPEG', quality=quality, optimize=True)
+        if not max_bytes or img_io.tell() <= max_bytes or quality <= THUMBNAIL_MIN_QUALITY:
+            return img_io.getvalue()
+        quality = max(THUMBNAIL_MIN_QUALITY, quality - 10)
+
+
+# EXTRACT EVERY IMAGE IN ONE PDF AS JPEG BYTES
+# returns (images, messages, counts): images is a list of (zip entry name, jpeg bytes),
+# messages a list of (streamlit level, text) for the app to show, since workers can't call st.*,
+# and counts how many images were copied straight from the PDF vs decoded and re-encoded
+# thumbnail, when given, is (max_px, quality, max_bytes) and every image is shrunk with make_thumbnail
+def extract_pdf_images(pdf_name, pdf_file_name, pdf_bytes, thumbnail=None):
+    images = []
+    messages = []
+    counts = {'copied': 0, 'reencoded': 0, 'thumbnails': 0}
+    pdf_reader = PdfReader(BytesIO(pdf_bytes))
+
+    for page_num, page in enumerate(pdf_reader.pages):
+        try:
+            xObject = page['/Resources']['/XObject'].get_object()
+        except KeyError:
+            # If there are no images in the page, skip it
+            messages.append(('warning', f"No images found in file: {pdf_name}, page: {page_num + 1}"))
+            continue
+
+        for obj in xObject:
+            if xObject[obj]['/Subtype'] != '/Image':
+                continue
+            img = xObject[obj]
+            try:
+                img_data = img.get_data()
+                # Perform a quick validation: Ensure the data is in a supported format.
+                if not img_data:
+                    messages.append(('error', f"Empty image data in file: {pdf_name}, page: {page_num + 1}"))
+                    continue
+                if thumbnail is None and is_jpeg_stream(img):
+                    images.append((f"{pdf_file_name}.jpg", img_data))
+                    counts['copied'] += 1
+                    continue
+                try:
+                    # Flate/raw and JPEG 2000 images are decoded and saved as JPEG
+                    img_pil = pdf_image(img, img_data)
+                    if thumbnail is not None:
+                        images.append((f"{pdf_file_name}.jpg", make_thumbnail(img_pil, *thumbnail)))
+                        counts['thumbnails'] += 1
+                        continue
+                    if img_pil.mode not in ('RGB', 'L'):
+                        #CMYK would be written back out as a CMYK JPEG
+                        img_pil = img_pil.convert('RGB')
+                    img_io = BytesIO()
+                    img_pil.save(img_io, 'JPEG')
+                    images.append((f"{pdf_file_name}.jpg", img_io.getvalue()))
+                    counts['reencoded'] += 1
+                except UnidentifiedImageError:
+                    messages.append(('error', f"Invalid image data from file: {pdf_name}, page: {page_num + 1}"))
+            except Exception as e:  # Catch generic errors and move to the next image
+                messages.append(('error', f"Error processing image from file: {pdf_name}, page: {page_num + 1} - {str(e)}"))
+
+    return images, messages, counts
+
+
+# Streamlit runs the app script as a __main__ module without a __spec__, so spawned workers would
+# re-run the whole app before importing this module; a __spec__ named __main__ makes multiprocessing skip that
+# the lock keeps two sessions starting pools at once from removing each other's spec
+_unimported_main_lock = threading.Lock()
+
+
+@contextmanager
+def unimported_main():
+    with _unimported_main_lock:
+        main = sys.modules['__main__']
+        if getattr(main, '__spec__', None) is not None:
+            yield
+            return
+        main.__spec__ = ModuleSpec('__main__', None)
+        try:
+            yield
+        finally:
+            main.__spec__ = None
+
+
+# pool size for the app: every worker is a full interpreter with PyPDF2 and PIL loaded, and in a
+# container os.cpu_count() reports the host's cores rather than what the instance can afford
+APP_PDF_MAX_WORKERS = 4
+
+
+# RUN extract_pdf_images OVER MANY PDFs IN A PROCESS POOL
+# yields each PDF's result as soon as it finishes; at most 2 PDFs per worker are in flight
+# so peak memory is bounded by the pool size rather than the number of uploads
+# pdf_jobs is a list; the pool never has more workers than PDFs
+def iter_pdf_images(pdf_jobs, max_workers=None, thumbnail=None):
+    if not pdf_jobs:
+        return
+    max_workers = min(max_workers or os.cpu_count() or 1, len(pdf_jobs))
+    max_in_flight = 2 * max_workers
+    pdf_jobs = iter(pdf_jobs)
+    # spawn instead of fork: the Streamlit server is multi-threaded
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        #start every worker now: left alone the pool spawns them on later submits, when __main__ may be
+        #a spec-less script again (this generator is suspended between yields, other sessions rerun)
+        with unimported_main():
+            wait([pool.submit(os.getpid) for _ in range(max_workers)])
+        in_flight = set()
+        while True:
+            for pdf_name, pdf_file_name, read_bytes in pdf_jobs:
+                in_flight.add(pool.submit(extract_pdf_images, pdf_name, pdf_file_name, read_bytes(), thumbnail))
+                if len(in_flight) >= max_in_flight:
+                    break
+            if not in_flight:
+                return
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+# WRITE EVERY EXTRACTED IMAGE INTO AN OPEN ZipFile AS SOON AS ITS PDF IS DONE
+# progress wraps the per-PDF results (e.g. stqdm), on_result(images, messages, counts) is called for each PDF
+# returns totals: images and bytes written plus the copied/reencoded/thumbnails counts
+def zip_pdf_images(zipf, pdf_jobs, thumbnail=None, max_workers=None, progress=None, on_result=None):
+    totals = {'images': 0, 'bytes': 0, 'copied': 0, 'reencoded': 0, 'thumbnails': 0}
+    results = iter_pdf_images(pdf_jobs, max_workers=max_workers, thumbnail=thumbnail)
+    if progress is not None:
+        results = progress(results, total=len(pdf_jobs))
+    for images, messages, counts in results:
+        for path, count in counts.items():
+            totals[path] += count
+        for img_name, img_data in images:
+            zipf.writestr(img_name, img_data)
+            totals['images'] += 1
+            totals['bytes'] += len(img_data)
+        if on_result is not None:
+            on_result(images, messages, counts)
+    return totals
+
+
+# THE APPLICANT ID IS THE SECOND UNDERSCORE-SEPARATED PART OF AN ERAS BULK PRINT FILE NAME
+def photo_name(pdf_file_name):
+    return os.path.basename(pdf_file_name).split("_")[1]
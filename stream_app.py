@@ -1,31 +1,52 @@
 import streamlit as st
 import pandas as pd
-from streamlit_folium import folium_static
-import folium
-import requests 
-import json
-from folium.plugins import MarkerCluster
 from stqdm import stqdm
 import streamlit_ext as ste
 from datetime import datetime
 
-from PyPDF2 import PdfReader
 from io import BytesIO
-from PIL import Image, UnidentifiedImageError
+import hashlib
 import zipfile
+import streamlit.components.v1 as components
+from applicants import read_applicants, missing_required_headers, prepare_applicants, read_previous_run
+from geocoding import GEOCODE_URL, GEOCODE_MAX_WORKERS, GEOCODE_QPS, new_geocode_stats, open_geocode_cache, evict_geocode_cache
+from geolocate import geocode_applicants
+from diagnostics import new_diagnostics, timed_stage, record_error, geocode_summary, diagnostics_json
+
+
+# WHAT TO TELL THE USER WHEN A STEP 2 STAGE FAILS (details go to the diagnostics panel)
+STAGE_WARNINGS = {
+    'read_csv': "NOT in CSV file format or has missing data",
+    'read_previous_run': "the previous-run file could not be read, upload the geocoded CSV or Parquet saved by this app",
+    'geocode': "geocoding failed, check the API key and geocoder settings in secrets.toml",
+    'aggregate': "the applicants could not be grouped into map areas, try another area size",
+    'build_map': "the map could not be drawn, try the lightweight markers or the aggregate view",
+}
+
+
+# KEY FOR MEMOIZING RESULTS IN st.session_state ACROSS RERUNS
+# hash of the uploaded bytes plus every option that changes the result
+def content_key(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else repr(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
 
 
 today = datetime.now().date()
 formatted_date = '10/2/23'
 
-stqdm.pandas()
 st.header("Geolocate ERAS Applicants")
 st.write(f"Last update: {formatted_date} [Phillip Kim, MD, MPH](https://www.doximity.com/pub/phillip-kim-md-8dccc4e4)")
-st.write("Upload raw CSV file from ERAS download to view map and output to HTML file. No data is saved on the server for privacy protection. Any resulting HTML file chosen to be saved locally will be at the program's discretion.")
+st.write("Upload raw CSV file from ERAS download to view map and output to HTML file. No applicant data is saved on the server for privacy protection (the optional geocode cache keeps only hashed addresses and their coordinates). Any resulting HTML file chosen to be saved locally will be at the program's discretion.")
 st.write("🛠️ Check out other tools-[Extract PDF Board Scores and FAILED attempts](https://extractscores.streamlit.app/)")
 st.image("sample_geo.jpg")
 eras = "https://auth.aamc.org/account/#/login?gotoUrl=http:%2F%2Fpdws.aamc.org%2Feras-pdws-web%2F"
 
+# stage timings, geocoding API usage and bytes produced by the most recent run of each step
+diagnostics = st.session_state.setdefault('diagnostics', new_diagnostics())
+
 tab1, tab2, tab3 = st.tabs(['🗂️ Step 1', '🗺️ Step 2', '📷 Step 3'])
 with tab1:
     markdown_text = f"""
@@ -74,152 +95,40 @@ with tab1:
 
 with tab2:
     check_image = st.checkbox ("Chere here to insert applicant profile image (MUST Complete Step 3)")
+    photo_thumbnails = st.session_state.get('photo_thumbnails', {})
+    embed_photos = check_image and st.checkbox(
+        f"Embed Step 3 thumbnails inside the HTML file so no image folder is needed ({len(photo_thumbnails)} available, run Step 3 with thumbnails first)",
+        disabled=not photo_thumbnails
+    )
+    lightweight_markers = st.checkbox("Lightweight map for large applicant lists (popups are built in the browser when clicked)")
+    aggregate_view = st.checkbox("Aggregate view for very large cohorts (heatmap and applicant counts per area instead of one marker per applicant)")
+    if aggregate_view:
+        from aggregation import GEOHASH_CELL_SIZES, GEOHASH_PRECISION
+        geohash_precision = st.selectbox(
+            "Area size", list(GEOHASH_CELL_SIZES), index=list(GEOHASH_CELL_SIZES).index(GEOHASH_PRECISION),
+            format_func=lambda precision: GEOHASH_CELL_SIZES[precision]
+        )
+    use_geocode_cache = st.checkbox("Reuse previously geocoded coordinates (only hashed addresses and coordinates are kept on the server)", value=True)
  
     st.write("Please locate and select downloaded CSV file for processing.  Once completed, please download the html file before moving to Step 3")
     upload_file = st.file_uploader("Upload CSV file")
-    expected_headers = ['Permanent Address', 'Applicant Name', 'AAMC ID', 'Medical School of Graduation', 'Medical School Type'] 
-    optional_headers = ['Medical School Country', 'Medical School Degree Date of Graduation', 'USMLE Step 1 Status','USMLE Step 1 Score', 'USMLE Step 2 CK Score', 'USMLE Step 2 CS Score', 'USMLE Step 3 Score', 'USMLE Step 3 Score','COMLEX-USA Level 1 Status', 'COMLEX-USA Level 1 Score', 'COMLEX-USA Level 2 CE Score', 'COMLEX-USA Level 2 PE Score', 'COMLEX-USA Level 3 Score', 'Division_Preference']
-
-    # FUNCTION TO GET COORDINATES FROM GOOGLE MAPS
-    st.cache()
-    def extract_lat_long_via_address(address_or_zipcode):
-        lat, lng = None, None
-        api_key = st.secrets['GOOGLE_API_KEY']
-        base_url = "https://maps.googleapis.com/maps/api/geocode/json"
-        endpoint = f"{base_url}?address={address_or_zipcode}&key={api_key}"
-        r = requests.get(endpoint)
-        if r.status_code not in range(200, 299):
-            return None, None
-        try:
-            results = r.json()['results'][0]
-            lat = results['geometry']['location']['lat']
-            lng = results['geometry']['location']['lng']
-        except:
-            pass
-        return lat, lng
-
-    # Create a long and lat column for each row then apply to dataframe
-    def enrich_with_geocoding_api(row):
-        column_name = 'Permanent Address'
-        address_value = row[column_name]
-        address_lat, address_lng = extract_lat_long_via_address(address_value)
-        row['lat'] = address_lat
-        row['lng'] = address_lng
-        return row
-
-    # Create POPUP HTML FOR EACH APPLICANT
-    def popup_html(row):
-        i = row
-        applicant_name=df['Applicant Name'].iloc[i]
-        aamc_id=df['AAMC ID'].iloc[i]
-
-        if check_image:
-            applicant_img = f"{aamc_id}.jpg"
-            image_html = f'<center><img src={applicant_img} alt="logo" width=100 height=100 ></center>'
-        else:
-            image_html = f'<center></center>'
-
-        medschool_name = df['Medical School of Graduation'].iloc[i]
-        medschool_type = df['Medical School Type'].iloc[i]
-        medschool_location =df['Medical School Country'].iloc[i]
-        graduate_date = df['Medical School Degree Date of Graduation'].iloc[i]
-
-        step1_status = df['USMLE Step 1 Status'].iloc[i]
-        step1_score = df['USMLE Step 1 Score'].iloc[i]
-        step2ck_score = df['USMLE Step 2 CK Score'].iloc[i]
-        step2cs_score = df['USMLE Step 2 CS Score'].iloc[i]
-        step3_score = df['USMLE Step 3 Score'].iloc[i]
-        
-        comlex1_status = df['COMLEX-USA Level 1 Status'].iloc[i]
-        comlex1_score = df['COMLEX-USA Level 1 Score'].iloc[i]
-        comlex2ce_score = df['COMLEX-USA Level 2 CE Score'].iloc[i]
-        comlex2pe_score = df['COMLEX-USA Level 2 PE Score'].iloc[i]
-        comlex3_score = df['COMLEX-USA Level 3 Score'].iloc[i]
-
-        div_pref = df['Division_Preference'].iloc[i]
-        
-        left_col_color = "#3e95b5"
-        right_col_color = "#f2f9ff"
-
-        html = f"""
-            <!DOCTYPE html>
-            <html>
-            {image_html}
-            <center><h4 style="margin-bottom:5"; width="200px">{applicant_name}</h4></center>
-
-            <center> <table style="height: 126px; width: 305px;">
-            <tbody>
-            <tr>
-            <td style="background-color: {left_col_color}; padding: 5px"><span style="color: #ffffff;"> AAMC ID </span></td>
-            <td style="width: 150px;background-color: {right_col_color}; padding: 5px">{aamc_id}</td>
-            </tr>
-            <tr>
-            <td style="background-color: {left_col_color}; padding: 5px"><span style="color: #ffffff;"> Med School </span></td>
-            <td style="width: 150px;background-color: {right_col_color}; padding: 5px">{medschool_name}</td>
-            </tr>
-            <tr>
-            <td style="background-color: {left_col_color}; padding: 5px"><span style="color: #ffffff;"> Med School Type </span></td>
-            <td style="width: 150px;background-color: {right_col_color}; padding: 5px">{medschool_type}</td>
-            </tr>
-            <tr>
-            <td style="background-color: {left_col_color}; padding: 5px"><span style="color: #ffffff;"> Country </span></td>
-            <td style="width: 150px;background-color: {right_col_color}; padding: 5px">{medschool_location}</td>
-            </tr>
-            <tr>
-            <td style="background-color: {left_col_color}; padding: 5px"><span style="color: #ffffff;"> Graduation Date </span></td>
-            <td style="width: 150px;background-color: {right_col_color}; padding: 5px">{graduate_date}</td>
-            </tr>
-            <tr>
-            <td style="background-color: {left_col_color}; padding: 5px"><span style="color: #ffffff;"> USMLE Step 1 </span></td>
-            <td style="width: 150px;background-color: {right_col_color}; padding: 5px">{step1_status}</td>
-            </tr>
-            <tr>
-            <td style="background-color: {left_col_color}; padding: 5px"><span style="color: #ffffff;"> USMLE Step 1 Score </span></td>
-            <td style="width: 150px;background-color: {right_col_color}; padding: 5px">{step1_score}</td>
-            </tr>
-            <tr>
-            <td style="background-color: {left_col_color}; padding: 5px"><span style="color: #ffffff;"> USMLE Step 2 CK </span></td>
-            <td style="width: 150px;background-color: {right_col_color}; padding: 5px">{step2ck_score}</td>
-            </tr>
-            <tr>
-            <td style="background-color: {left_col_color}; padding: 5px"><span style="color: #ffffff;"> USMLE Step 2 CS </span></td>
-            <td style="width: 150px;background-color: {right_col_color}; padding: 5px">{step2cs_score}</td>
-            </tr>
-            <tr>
-            <td style="background-color: {left_col_color}; padding: 5px"><span style="color: #ffffff;"> USMLE Step 3 </span></td>
-            <td style="width: 150px;background-color: {right_col_color}; padding: 5px">{step3_score}</td>
-            </tr>
-            <tr>
-            <td style="background-color: {left_col_color}; padding: 5px"><span style="color: #ffffff;"> COMLEX Level 1 </span></td>
-            <td style="width: 150px;background-color: {right_col_color}; padding: 5px">{comlex1_status}</td>
-            </tr>
-            <tr>
-            <td style="background-color: {left_col_color}; padding: 5px"><span style="color: #ffffff;"> COMLEX Level 1 Score </span></td>
-            <td style="width: 150px;background-color: {right_col_color}; padding: 5px">{comlex1_score}</td>
-            </tr>
-            <tr>
-            <td style="background-color: {left_col_color}; padding: 5px"><span style="color: #ffffff;"> COMLEX Level 2 CE </span></td>
-            <td style="width: 150px;background-color: {right_col_color}; padding: 5px">{comlex2ce_score}</td>
-            </tr>
-
-            <tr>
-            <td style="background-color:{left_col_color}; padding: 5px"><span style="color: #ffffff;"> COMLEX Level 3 </span></td>
-            <td style="width: 150px;background-color: {right_col_color}; padding: 5px">{comlex3_score}</td>
-            </tr>
-            <tr>
-            <td style="background-color:{left_col_color}; padding: 5px"><span style="color: #ffffff;"> Division Pref</span></td>
-            <td style="width: 150px;background-color: {right_col_color}; padding: 5px">{div_pref}</td>
-            </tr>
-            </tbody>
-            </table></center>
-            </html>
-            """ 
-        return html
-
+    previous_file = st.file_uploader("Optional: upload the geocoded CSV (or Parquet) saved from a previous run to only geocode new or changed applicants", type=['csv', 'parquet'])
+    # geocoded applicants, the rendered map and the photo ZIP are kept in st.session_state keyed by
+    # content_key() so widget reruns reuse them instead of geocoding and rendering again; an explicit
+    # Analyze click always geocodes again, e.g. to retry addresses that failed during an outage
+    geocoded = st.session_state.get('geocoded')
     geo_df = pd.DataFrame()
     if upload_file is not None: 
+        #the stage running when something raises, so the error is reported against it
+        stage = 'read_csv'
         try:
-            df = pd.read_csv(upload_file)
+            upload_key = content_key(upload_file.getvalue())
+            if st.session_state.get('applicants', {}).get('key') != upload_key:
+                diagnostics['errors'] = []
+                with timed_stage(diagnostics, 'read_csv'):
+                    st.session_state['applicants'] = {'key': upload_key, 'df': read_applicants(upload_file)}
+                diagnostics['bytes']['upload_csv'] = len(upload_file.getvalue())
+            df = st.session_state['applicants']['df']
             total_count = df.shape[0]
             
             #total_count = len(df.index)
@@ -228,26 +137,71 @@ with tab2:
                 st.warning("Following with MISSING Permanent Address will not be processed:")
                 st.dataframe(df[df['Permanent Address'].isnull()])
                 #df = df.dropna(subset=['Permanent Address'])
-            #auto assign NaN to missing optional_headers
-            missing_headers = [i for i in optional_headers if i not in set(df.columns.tolist())]
-            #create missing headers first then assign 
-            if missing_headers:
-                df.reindex(columns=df.columns.tolist() + list(missing_headers))
         
             #clean up the address 
             #perform data analysis to obtain geo coord
-            if all(col in df.columns for col in expected_headers):
-                df['Permanent Address'] = df['Permanent Address'].str.replace('#', '')
+            set_diff = missing_required_headers(df)
+            if not set_diff:
+                df = prepare_applicants(df.copy())
+                geocode_key = content_key(upload_key, previous_file.getvalue() if previous_file is not None else b'', use_geocode_cache)
                 if st.button("Analyze"):
-                    df = df.dropna(subset=['Permanent Address'])
+                    diagnostics['errors'] = []
                     with st.spinner("Performing Analysis and Creating Map Coordinates this may take a while..."):
-                        geo_df = df.progress_apply(enrich_with_geocoding_api, axis=1)                     
+                        stage = 'read_previous_run'
+                        previous = read_previous_run(previous_file) if previous_file is not None else None
+                        stage = 'geocode'
+                        geocode_stats = new_geocode_stats()
+                        geocode_notes = []
+                        geocode_cache = None
+                        #summarized even when geocoding fails part way, so the failed requests show up
+                        reused = 0
+                        try:
+                            with timed_stage(diagnostics, 'geocode'):
+                                if use_geocode_cache:
+                                    geocode_cache = open_geocode_cache()
+                                    evict_geocode_cache(geocode_cache)
+                                #geocoder endpoint and limits can be overridden in secrets.toml
+                                geocode_options = dict(
+                                    api_key=st.secrets['GOOGLE_API_KEY'],
+                                    base_url=st.secrets.get('GEOCODE_URL', GEOCODE_URL),
+                                    cache=geocode_cache,
+                                    stats=geocode_stats,
+                                    max_workers=int(st.secrets.get('GEOCODE_MAX_WORKERS', GEOCODE_MAX_WORKERS)),
+                                    qps=float(st.secrets.get('GEOCODE_QPS', GEOCODE_QPS)),
+                                    progress=stqdm
+                                )
+                                geocoded_df, reused = geocode_applicants(df, previous, **geocode_options)
+                        finally:
+                            diagnostics['geocode'] = geocode_summary(geocode_stats, reused)
+                            if geocode_cache is not None:
+                                geocode_cache.close()
+                        if previous is not None:
+                            geocode_notes.append(f"Reused coordinates for {reused} applicant(s) from the previous run, geocoding {len(geocoded_df) - reused} new or changed")
+                        saved_lookups = geocode_stats['rows'] - geocode_stats['unique']
+                        geocode_notes.append(f"{geocode_stats['rows']} addresses collapsed to {geocode_stats['unique']} unique lookups ({saved_lookups} saved by deduplication)")
+                        if use_geocode_cache:
+                            geocode_notes.append(f"Geocode cache: {geocode_stats['hits']} hits, {geocode_stats['misses']} misses")
+                        geocoded = {
+                            'key': geocode_key,
+                            #each Analyze run gets its own id so the map and aggregates are rebuilt from it
+                            'run': (geocoded or {}).get('run', 0) + 1,
+                            'geo_df': geocoded_df,
+                            #keep every row, including failed ones, so the next run can be incremental
+                            'csv': geocoded_df.to_csv(index=False).encode('utf-8'),
+                            'notes': geocode_notes,
+                        }
+                        diagnostics['bytes']['geocoded_csv'] = len(geocoded['csv'])
+                        st.session_state['geocoded'] = geocoded
+                if geocoded is not None and geocoded['key'] == geocode_key:
+                    geo_df = geocoded['geo_df']
+                    for note in geocoded['notes']:
+                        st.caption(note)
             else:
                 #looks if CVS data contains required headers
-                set_diff = [x for x in expected_headers if x not in set(df.columns.tolist())]
                 st.error(f"Required column header name(s) are missing to process: {list(set_diff)}")
-        except:
-            st.warning("😬 Something went wrong: NOT in CSV file format or has missing data")
+        except Exception as e:
+            record_error(diagnostics, stage, e)
+            st.warning(f"😬 Something went wrong: {STAGE_WARNINGS[stage]} ({type(e).__name__}, see Diagnostics below)")
 
     if not geo_df.empty:
         #count empty NaN in coordinates
@@ -256,43 +210,80 @@ with tab2:
         if nan_count: 
             st.subheader("😟 Following applicant(s) were unable to get coordinates.  You can try to fix the permanent address format and re-upload CSV") 
             st.dataframe(geo_df[geo_df['lng'].isnull()])
-        #drop NaN and reset index to avoid indexing errors
         geo_df = geo_df.dropna(subset=["lat"])
-        geo_df = geo_df.reset_index(drop=True)
-
-        m = folium.Map(location=geo_df[["lat", "lng"]].mean().to_list(), zoom_start=2)
-        # if the points are too close to each other, cluster them, create a cluster overlay with MarkerCluster, add to m
-        marker_cluster = MarkerCluster().add_to(m)
-        # draw the markers and assign popup and hover texts
-        # add the markers the the cluster layers so that they are automatically clustered               
-        for i,r in geo_df.iterrows():
-            location = (r["lat"], r["lng"])
-            #id foreign, US, DO
-            medschool_type = df['Medical School Type'].iloc[i]
-            if medschool_type == 'US M.D. Private School' or medschool_type == 'US M.D. Public School':
-                color = 'red'
-                tooltip = 'MD-US-Grad'
-            elif medschool_type == 'US D.O. School':
-                color = 'darkblue'
-                tooltip = 'DO-US-Grad'
+        if geo_df.empty:
+            st.warning("No applicant could be geocoded. If the geocoding service was unavailable, click Analyze again to retry the failed addresses.")
+
+    if not geo_df.empty:
+
+        map_html = None
+        try:
+            stage = 'aggregate' if aggregate_view else 'build_map'
+            if aggregate_view:
+                # cells and region rollups are computed once per geocoded result and area size
+                from aggregation import aggregate_cells, aggregate_regions
+
+                aggregates_key = content_key(geocoded['key'], geocoded['run'], geohash_precision)
+                if st.session_state.get('aggregates', {}).get('key') != aggregates_key:
+                    with timed_stage(diagnostics, 'aggregate'):
+                        st.session_state['aggregates'] = {
+                            'key': aggregates_key,
+                            'cells': aggregate_cells(geo_df, geohash_precision),
+                            'regions': aggregate_regions(geo_df),
+                        }
+                aggregates = st.session_state['aggregates']
+                diagnostics['aggregate'] = {'precision': geohash_precision, 'cells': len(aggregates['cells']), 'regions': len(aggregates['regions'])}
+                map_key = content_key(aggregates_key, 'aggregate')
+                stage = 'build_map'
             else:
-                color = 'gray'
-                tooltip = 'MD-IMG-Grad'
-        
-            html = popup_html(i)
-            folium.Marker(location=location, popup=html, tooltip=tooltip, icon=folium.Icon(color=color, icon='user', prefix='fa')).add_to(marker_cluster)
-
-        m.save("geo_applicants.html")
-        folium_static(m, width=725)
-        #use ste download button method to avoid clear recent data analysis upon download 
-        with open("geo_applicants.html", "rb") as file:
-            btn = ste.download_button(
+                photos_key = st.session_state.get('photo_zip', {}).get('key') if embed_photos else None
+                map_key = content_key(geocoded['key'], geocoded['run'], lightweight_markers, check_image, photos_key)
+            if st.session_state.get('map_html', {}).get('key') != map_key:
+                # folium is only loaded once there is a map to draw
+                from applicant_map import image_sources, build_map, build_aggregate_map
+
+                image_srcs = None
+                if check_image and not aggregate_view:
+                    image_srcs = image_sources(geo_df['AAMC ID'], photo_thumbnails if embed_photos else None)
+                with timed_stage(diagnostics, 'build_map'):
+                    if aggregate_view:
+                        m = build_aggregate_map(aggregates['cells'])
+                    else:
+                        m = build_map(geo_df, lightweight=lightweight_markers, image_srcs=image_srcs)
+                #rendered once in memory; each user gets their own copy instead of a shared file on disk
+                with timed_stage(diagnostics, 'render_html'):
+                    st.session_state['map_html'] = {'key': map_key, 'html': m.get_root().render()}
+                diagnostics['bytes']['map_html'] = len(st.session_state['map_html']['html'].encode('utf-8'))
+            map_html = st.session_state['map_html']['html']
+        except Exception as e:
+            record_error(diagnostics, stage, e)
+            st.warning(f"😬 Something went wrong: {STAGE_WARNINGS[stage]} ({type(e).__name__}, see Diagnostics below)")
+
+        if map_html is not None:
+            components.html(map_html, width=725, height=500)
+            #use ste download button method to avoid clear recent data analysis upon download 
+            ste.download_button(
                 label="Download file as HTML file",
-                data=file,
+                data=map_html,
                 file_name="geo_applicants.html",
                 mime='txt/html'
             )
             st.write("Use a browser to open the downloaded HTML file for offline viewing")
+            ste.download_button(
+                label="Download geocoded data as CSV (upload next time to skip unchanged applicants)",
+                data=geocoded['csv'],
+                file_name="geo_applicants.csv",
+                mime='text/csv'
+            )
+            if aggregate_view:
+                st.subheader(f"Applicants by country / US state ({len(aggregates['cells'])} map areas)")
+                st.dataframe(aggregates['regions'])
+                ste.download_button(
+                    label="Download counts per country / US state as CSV",
+                    data=aggregates['regions'].to_csv(index=False).encode('utf-8'),
+                    file_name="geo_applicants_regions.csv",
+                    mime='text/csv'
+                )
 
 #####PROCESS PDF TO JPEG#####
 with tab3:
@@ -316,76 +307,89 @@ with tab3:
     15. Open the geo_applicants.html file in a web-browser to view and interact applicant data
     """)
     st.info("Please do NOT modify any file names upon download as this will impact the profile images in HTML")
+    make_thumbnails = st.checkbox("Shrink photos to map-sized thumbnails (smaller ZIP and HTML, required to embed photos in Step 2)")
+    if make_thumbnails:
+        thumb_col1, thumb_col2, thumb_col3 = st.columns(3)
+        thumb_px = thumb_col1.number_input("Max width/height (px)", min_value=50, max_value=1000, value=200, step=50)
+        thumb_quality = thumb_col2.slider("JPEG quality", min_value=30, max_value=95, value=80)
+        thumb_budget_mb = thumb_col3.number_input("Total size budget (MB, 0 = none)", min_value=0.0, value=0.0, step=1.0)
     # Upload multiple PDFs
     uploaded_files = st.file_uploader("Upload multiple PDFs", type=["pdf"], accept_multiple_files=True)
     
     if uploaded_files:
-        # Add a processing spinner
-        with st.spinner("Converting PDFs to images..."):
-
-            image_list = []
-
-            # Create a BytesIO object to store the ZIP file
-            zip_buffer = BytesIO()
-
-            # Extract images from PDFs and save as JPGs in memory (BytesIO)
-            for pdf_file in uploaded_files:
-                #st.write(f"Processing file: {pdf_file.name}")  # Debug log
-
-                pdf_file_name = pdf_file.name.split("_")[1]  # Get the name part from filename
-                pdf_reader = PdfReader(pdf_file)
-                num_pages = len(pdf_reader.pages)
-                #st.write(f"Number of pages in {pdf_file.name}: {num_pages}")  # Debug log
-
-                for page_num in range(num_pages):
-                    page = pdf_reader.pages[page_num]
-                    #st.write(f"Processing page {page_num + 1} of {pdf_file.name}")  # Debug log
-
-                    try:
-                        xObject = page['/Resources']['/XObject'].get_object()
-                        #st.write(f"Found XObject on page {page_num + 1} of {pdf_file.name}")  # Debug log
-
-                        for obj in xObject:
-                            if xObject[obj]['/Subtype'] == '/Image':
-                                img = xObject[obj]
-                                try:
-                                    img_data = img.get_data()
-                                    img_bytes = BytesIO(img_data)
-
-                                    # Perform a quick validation: Ensure the data is in a supported format.
-                                    if img_bytes.getbuffer().nbytes > 0:
-                                        try:
-                                            # Try to open the image
-                                            img_pil = Image.open(img_bytes)
-                                            #st.write(f"Image extracted from page {page_num + 1} of {pdf_file.name}")  # Debug log
-                                            
-                                            # Save the image as a BytesIO object
-                                            img_io = BytesIO()
-                                            img_pil.save(img_io, 'JPEG')
-                                            image_list.append((f"{pdf_file_name}.jpg", img_io))
-                                        except UnidentifiedImageError:
-                                            st.error(f"Invalid image data from file: {pdf_file.name}, page: {page_num + 1}")
-                                    else:
-                                        st.error(f"Empty image data in file: {pdf_file.name}, page: {page_num + 1}")
-                                except (UnidentifiedImageError, Exception) as e:  # Catch generic errors
-                                    st.error(f"Error processing image from file: {pdf_file.name}, page: {page_num + 1} - {str(e)}")
-                                    continue  # Skip this image and move to the next
-                    except KeyError:
-                        # If there are no images in the page, skip it
-                        st.warning(f"No images found in file: {pdf_file.name}, page: {page_num + 1}")
-                        continue
-
-            # Create a ZIP file in memory
-            if image_list:
-                with zipfile.ZipFile(zip_buffer, "w") as zipf:
-                    for img_name, img_io in image_list:
-                        img_io.seek(0)
-                        zipf.writestr(img_name, img_io.read())
-
-                st.success("Images converted and zipped successfully!")
-
-                # Provide a link to download the ZIP file
-                st.markdown("### Download ZIP file")
-                st.download_button("Click here to download ZIP", data=zip_buffer.getvalue(), file_name="converted_images.zip", key="download_btn")
-            else:
-                st.warning("No images were found or processed from the uploaded PDFs.")
\ No newline at end of file
+        thumbnail = None
+        if make_thumbnails:
+            # the total budget is split evenly so each worker can enforce its share on its own
+            per_image_budget = int(thumb_budget_mb * 1024 * 1024 / len(uploaded_files))
+            thumbnail = (int(thumb_px), int(thumb_quality), per_image_budget)
+        photos_key = content_key(thumbnail, *[part for pdf_file in uploaded_files for part in (pdf_file.name, pdf_file.getvalue())])
+
+        photo_zip = st.session_state.get('photo_zip')
+        if photo_zip is None or photo_zip['key'] != photos_key:
+            # PDF and image libraries are only loaded once there is something to convert
+            from pdf_photos import APP_PDF_MAX_WORKERS, zip_pdf_images, photo_name
+
+            # Add a processing spinner
+            with st.spinner("Converting PDFs to images..."):
+                photo_messages = []
+                thumbnails = {}
+
+                def keep_result(images, messages, counts):
+                    photo_messages.extend(messages)
+                    if make_thumbnails:
+                        for img_name, img_data in images:
+                            thumbnails[img_name[:-len('.jpg')]] = img_data
+
+                # Create a BytesIO object to store the ZIP file
+                zip_buffer = BytesIO()
+
+                # Extract images from PDFs across a process pool and write each one into the ZIP as soon as it is done
+                # each upload is read only when a worker is free to take it
+                pdf_jobs = [(pdf_file.name, photo_name(pdf_file.name), pdf_file.getvalue) for pdf_file in uploaded_files]
+                with timed_stage(diagnostics, 'extract_photos'), zipfile.ZipFile(zip_buffer, "w") as zipf:
+                    totals = zip_pdf_images(
+                        zipf, pdf_jobs, thumbnail=thumbnail, max_workers=APP_PDF_MAX_WORKERS, progress=stqdm, on_result=keep_result
+                    )
+
+                photo_zip = {'key': photos_key, 'zip': zip_buffer.getvalue(), 'totals': totals, 'messages': photo_messages}
+                diagnostics['photos'] = {key: totals[key] for key in ('images', 'copied', 'reencoded', 'thumbnails')}
+                diagnostics['bytes']['photo_images'] = totals['bytes']
+                diagnostics['bytes']['photo_zip'] = len(photo_zip['zip'])
+                st.session_state['photo_zip'] = photo_zip
+                st.session_state['photo_thumbnails'] = thumbnails
+
+        for level, text in photo_zip['messages']:
+            getattr(st, level)(text)
+        totals = photo_zip['totals']
+        zip_bytes = totals['bytes']
+        if totals['images']:
+            st.success("Images converted and zipped successfully!")
+            st.caption(f"{totals['copied']} JPEG image(s) copied directly, {totals['reencoded']} decoded and re-encoded, {totals['thumbnails']} thumbnail(s), {zip_bytes / 1024 / 1024:.1f} MB total")
+            if make_thumbnails and thumb_budget_mb and zip_bytes > thumb_budget_mb * 1024 * 1024:
+                st.warning(f"Photos exceed the {thumb_budget_mb:g} MB budget even at the lowest quality; try a smaller max size")
+
+            # Provide a link to download the ZIP file
+            st.markdown("### Download ZIP file")
+            st.download_button("Click here to download ZIP", data=photo_zip['zip'], file_name="converted_images.zip", key="download_btn")
+        else:
+            st.warning("No images were found or processed from the uploaded PDFs.")
+
+#####DIAGNOSTICS#####
+with st.expander("Diagnostics: stage timings, geocoding requests and output sizes"):
+    if not diagnostics['stages']:
+        st.write("Nothing has run yet in this session.")
+    else:
+        st.caption("Seconds spent in the most recent run of each stage")
+        st.bar_chart(pd.Series(diagnostics['stages'], name='seconds'))
+        geocode = diagnostics['geocode']
+        if geocode is not None and geocode['latency']['count']:
+            st.caption(f"Geocoding request latency: p50 {geocode['latency']['p50_ms']} ms, p99 {geocode['latency']['p99_ms']} ms over {geocode['requests']} request(s)")
+            #a table keeps the buckets in latency order
+            st.table(pd.Series(geocode['latency']['histogram'], name='requests'))
+        st.json(diagnostics)
+        ste.download_button(
+            label="Download diagnostics as JSON",
+            data=diagnostics_json(diagnostics),
+            file_name="geolocate_diagnostics.json",
+            mime='application/json'
+        )